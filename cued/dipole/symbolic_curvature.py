@@ -1,11 +1,17 @@
 import numpy as np
 import sympy as sp
-import matplotlib.pyplot as plt
 
 from cued.utility import evaluate_njit_matrix, matrix_to_njit_functions
 
-plt.rcParams['figure.figsize'] = [12, 15]
-plt.rcParams['text.usetex'] = True
+
+def _pyplot():
+    '''
+    matplotlib is only imported once a plot is made
+    '''
+    import matplotlib.pyplot as plt
+    plt.rcParams['figure.figsize'] = [12, 15]
+    plt.rcParams['text.usetex'] = True
+    return plt
 
 
 class SymbolicCurvature():
@@ -83,6 +89,7 @@ class SymbolicCurvature():
 
         Be = np.real(Be)
 
+        plt = _pyplot()
         fig, ax = plt.subplots(1, 2)
         fig.suptitle(title, fontsize=16)
 
@@ -1,10 +1,17 @@
 import sympy as sp
 import numpy as np
-import matplotlib.pyplot as plt
 from cued.utility import evaluate_njit_matrix, matrix_to_njit_functions
 
-plt.rcParams['figure.figsize'] = [150, 15]
-plt.rcParams['text.usetex'] = True
+
+def _pyplot():
+    '''
+    matplotlib is only imported once a plot is made
+    '''
+    import matplotlib.pyplot as plt
+    plt.rcParams['figure.figsize'] = [150, 15]
+    plt.rcParams['text.usetex'] = True
+    return plt
+
 
 class SymbolicDipole():
     """
@@ -166,6 +173,7 @@ class SymbolicDipole():
         Axe_rn, Axe_in = Axe_r/norm_r, Axe_i/norm_i
         Aye_rn, Aye_in = Aye_r/norm_r, Aye_i/norm_i
 
+        plt = _pyplot()
         fig, ax = plt.subplots(2, 2)
         if title is not None:
             fig.suptitle(title, fontsize=16)
@@ -47,3 +47,37 @@ def make_electric_field_ortho(P):
 
     return electric_field
 
+
+def make_stage_field_table(electric_field, P, order=5):
+    """
+    Tabulates the electric field and the vector potential A(t) = -int_t0^t E(t') dt'
+    on the stage grid t0 + m*dt/2, m = 0, ..., 2*Nt, of the rk4 solver. A is integrated
+    with Gauss-Legendre quadrature of the given order on every half step.
+    """
+    t_stage = P.t0 + 0.5*P.dt*np.arange(2*P.Nt + 1)
+    E_stage = np.array([electric_field(t) for t in t_stage], dtype=P.type_real_np)
+
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    t_nodes = t_stage[:-1, np.newaxis] + 0.25*P.dt*(nodes[np.newaxis, :] + 1)
+    E_nodes = np.array([electric_field(t) for t in t_nodes.ravel()]).reshape(t_nodes.shape)
+    dA = -0.25*P.dt*(E_nodes @ weights)
+    A_stage = np.append(0, np.cumsum(dA)).astype(P.type_real_np)
+
+    return E_stage, A_stage
+
+def make_stage_field_lookup(E_stage, P):
+    """
+    Creates a jitted function that returns the tabulated field at a time of the
+    stage grid instead of evaluating the pulse
+    """
+    t0 = P.t0
+    dt = P.dt
+
+    @conditional_njit(P.type_real_np)
+    def electric_field(t):
+        '''
+        Returns the driving field at the closest stage time
+        '''
+        return E_stage[int(round(2*(t - t0)/dt))]
+
+    return electric_field
@@ -5,6 +5,7 @@ import math
 from sympy.physics.quantum import TensorProduct
 from sympy.physics.quantum.dagger import Dagger
 from cued.utility import evaluate_njit_matrix, list_to_njit_functions, matrix_to_njit_functions
+from cued.utility import matrices_to_fused_njit_function
 
 class NBandHamiltonianSystem():
 
@@ -39,6 +40,7 @@ class NBandHamiltonianSystem():
         self.n = h.shape[0]
 
         self.hfjit = None
+        self.hfusedjit = None     # h, dh/dkx and dh/dky in one function
 
         self.e_in_path = None   #set when eigensystem_dipole_path is called
         self.wf_in_path = None
@@ -367,6 +369,7 @@ class NBandHamiltonianSystem():
             self.hfjit = matrix_to_njit_functions(self.h, self.hsymbols, dtype=P.type_complex_np)
             self.hderivfjit = [matrix_to_njit_functions(hd, self.hsymbols, dtype=P.type_complex_np)
                             for hd in self.hderiv]
+            self.hfusedjit = matrices_to_fused_njit_function([self.h] + self.hderiv, self.hsymbols, dtype=P.type_complex_np)
             
             if self.ana_e is not None:
                 self.__normalize_eigenvectors()
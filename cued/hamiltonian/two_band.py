@@ -1,12 +1,20 @@
 import numpy as np
 import sympy as sp
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D  # NOQA
 
 from cued.utility import list_to_njit_functions, matrix_to_njit_functions, to_njit_function
-from cued.utility import evaluate_njit_matrix
-plt.rcParams['figure.figsize'] = [12, 15]
-plt.rcParams['text.usetex'] = True
+from cued.utility import matrices_to_fused_njit_function
+from cued.utility import evaluate_njit_matrix, load_symbolic_cache, store_symbolic_cache
+
+
+def _pyplot():
+    '''
+    matplotlib is only imported once a plot is made
+    '''
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D  # NOQA
+    plt.rcParams['figure.figsize'] = [12, 15]
+    plt.rcParams['text.usetex'] = True
+    return plt
 
 
 class TwoBandHamiltonianSystem():
@@ -57,6 +65,8 @@ class TwoBandHamiltonianSystem():
         self.efjit = None
         self.ederivjit = None
 
+        self.hfusedjit = None     # h, dh/dkx and dh/dky in one function
+
         # Get set when eigensystem is called (gauge needed)
         self.U = None             # Normalised eigenstates
         self.U_h = None           # Hermitian conjugate
@@ -220,12 +230,20 @@ class TwoBandHamiltonianSystem():
     def make_eigensystem_dipole(self, P):
 
         self.e = self.__energies()
-        self.ederiv = self.__energy_derivatives()
+
+        # Symbolic derivatives from the on-disk cache (opt-in), sympy only runs for new models
+        key = '|'.join([sp.srepr(self.h), str(P.gidx), sp.srepr(self.kdotp)])
+        cached = load_symbolic_cache(key) if P.symbolic_cache else None
+        if cached is None:
+            self.ederiv = self.__energy_derivatives()
+        else:
+            self.ederiv = cached['ederiv']
 
                 # Jitted Hamiltonian and energies
         self.hfjit = matrix_to_njit_functions(self.h, self.hsymbols, dtype=P.type_complex_np)
         self.hderivfjit = [matrix_to_njit_functions(hd, self.hsymbols, dtype=P.type_complex_np)
                            for hd in self.hderiv]
+        self.hfusedjit = matrices_to_fused_njit_function([self.h] + self.hderiv, self.hsymbols, dtype=P.type_complex_np)
 
         self.efjit = list_to_njit_functions(self.e, self.hsymbols, dtype=P.type_complex_np)
         self.ederivfjit = list_to_njit_functions(self.ederiv, self.hsymbols, dtype=P.type_complex_np)
@@ -237,7 +255,9 @@ class TwoBandHamiltonianSystem():
         else:
             self.coulomb_matrix_jit = to_njit_function(self.coulomb_2d, self.hsymbols, dtype=P.type_complex_np)
 
-        if self.kdotp is None:
+        if cached is not None:
+            self.Ax, self.Ay = cached['Ax'], cached['Ay']
+        elif self.kdotp is None:
             self.Ax, self.Ay = self.__fields(self.U, self.U_h)
         else:
             self.Ax, self.Ay = self.__kdotp_fields(self.kdotp, self.e[0], self.e[1])
@@ -251,7 +271,12 @@ class TwoBandHamiltonianSystem():
 
         # Curvature
 
-        self.B = sp.diff(self.Ax, self.ky) - sp.diff(self.Ay, self.kx)
+        if cached is None:
+            self.B = sp.diff(self.Ax, self.ky) - sp.diff(self.Ay, self.kx)
+            if P.symbolic_cache:
+                store_symbolic_cache(key, {'ederiv': self.ederiv, 'Ax': self.Ax, 'Ay': self.Ay, 'B': self.B})
+        else:
+            self.B = cached['B']
         self.Bfjit = matrix_to_njit_functions(self.B, self.hsymbols, dtype=P.type_complex_np)
 
         if P.dm_dynamics_method == 'EEA':
@@ -278,7 +303,7 @@ class TwoBandHamiltonianSystem():
                     for j in range(P.Nk2_buf):
                         dist_k = np.sqrt((i*dkx)**2 + (j*dky)**2)
                         if not ( i == 0 and j == 0):
-                            self.v_k_kprime[i, j] = P.kweight * self.coulomb_matrix_jit(kx=dist_k, ky=0)
+                            self.v_k_kprime[i, j] = P.kweight * self.coulomb_matrix_jit(kx=dist_k, ky=0.0)
                                                         
             else:
                 for i in range(P.Nk1):
@@ -290,7 +315,7 @@ class TwoBandHamiltonianSystem():
                         else:
                             dist_k = np.sqrt((i*dkx)**2 + (j*dky)**2)
                         if not ( i == 0 and j == 0 ):
-                            self.v_k_kprime[i, j] = P.kweight * self.coulomb_matrix_jit(kx=dist_k, ky=0)
+                            self.v_k_kprime[i, j] = P.kweight * self.coulomb_matrix_jit(kx=dist_k, ky=0.0)
                         
     def eigensystem(self, P):
         """
@@ -375,6 +400,7 @@ class TwoBandHamiltonianSystem():
         return self.B_eval
 
     def plot_bands_3d(self, kx, ky, title="Energies"):
+        plt = _pyplot()
         fig = plt.figure()
         ax = fig.gca(projection='3d')
         ax.plot_trisurf(kx, ky.T, self.e_eval[0])
@@ -421,6 +447,7 @@ class TwoBandHamiltonianSystem():
                                " be evaluated on a kgrid to plot them. "
                                " Call evaluate before plotting.")
 
+        plt = _pyplot()
         fig, ax = plt.subplots(1, 2)
         fig.suptitle(title, fontsize=16)
 
@@ -486,6 +513,7 @@ class TwoBandHamiltonianSystem():
         ev = E[vidx].reshape(dim, dim)
         ec = E[cidx].reshape(dim, dim)
 
+        plt = _pyplot()
         fig, ax = plt.subplots(1, 2)
         fig.suptitle(title, fontsize=16)
 
@@ -527,6 +555,7 @@ class TwoBandHamiltonianSystem():
         decx = self.ederiv_eval[2]
         decy = self.ederiv_eval[3]
 
+        plt = _pyplot()
         fig, ax = plt.subplots(1, 2)
         fig.suptitle(title, fontsize=16)
 
@@ -614,6 +643,7 @@ class TwoBandHamiltonianSystem():
         Axe_rn, Axe_in = Axe_r/norm_r, Axe_i/norm_i
         Aye_rn, Aye_in = Aye_r/norm_r, Aye_i/norm_i
 
+        plt = _pyplot()
         fig, ax = plt.subplots(2, 2)
         if title is not None:
             fig.suptitle(title, fontsize=16)
@@ -721,6 +751,7 @@ class TwoBandHamiltonianSystem():
 
         Be = np.real(Be)
 
+        plt = _pyplot()
         fig, ax = plt.subplots(1, 2)
         fig.suptitle(title, fontsize=16)
 
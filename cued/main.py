@@ -1,23 +1,28 @@
 from itertools import product
+import copy
+import inspect
+import os
+import shutil
 import numpy as np
 from numpy.fft import fftshift, fft, ifftshift, ifft, fftfreq
 from scipy.integrate import ode
 import time
 from typing import OrderedDict
-from numba import njit
+from numba import njit, config, set_num_threads
 
 from cued.utility import FrequencyContainers, TimeContainers, ScreeningContainers, ParamsParser
 from cued.utility import ConversionFactors as CoFa
-from cued.utility import MpiHelpers, rmdir_mkdir_chdir, chdir
-from cued.plotting import write_and_compile_latex_PDF, read_dataset
+from cued.utility import MpiHelpers, rmdir_mkdir_chdir, chdir, spectral_k_derivative
+from cued.utility import read_cache_files, write_cache_files
+from cued.plotting import read_dataset
 from cued.kpoint_mesh import hex_mesh, rect_mesh
+from cued.fields import make_stage_field_table, make_stage_field_lookup
 from cued.observables import *
-from cued.plotting import write_and_compile_screening_latex_PDF
 from cued.rhs_ode import *
 
 import sys as system
 
-def sbe_solver(sys, params):
+def sbe_solver(sys, params, return_currents=False):
 	"""
 	Function that initializes MPI-parallelization and distributes parameters that are given as a
 	list in the params.py file to the individual MPI-processes. Runs the SBE-calculation for each
@@ -29,6 +34,14 @@ def sbe_solver(sys, params):
 		Symbolic Hamiltonian of the system
 	params : class
 		parameters of the params.py file
+	return_currents : bool
+		return the currents of the local parameter combinations
+
+	Returns
+	-------
+	results : list
+		dictionaries of current_arrays for the local parameter combinations
+		(empty if return_currents is False)
 	"""
 
 	# Initialize Mpi and parse params
@@ -42,41 +55,65 @@ def sbe_solver(sys, params):
 
 	P.combined_parallelization = False
 
-	# Parallelize over paths and parameters if the following conditions are met:
-	#  - Number of tasks % Nk2 = 0
-	#  - Number of params % (number of tasks / Nk2 ) == 0
-	#  - Number of tasks <= Nk2 * number of params
-	if Mpi.size > params.Nk2 and Mpi.size > P.number_of_combinations and not (P.parallelize_over_points or P.split_paths) :
-		if Mpi.size % params.Nk2 == 0 and P.number_of_combinations % (Mpi.size/params.Nk2) == 0 and Mpi.size <= P.number_of_combinations*params.Nk2:
-			if Mpi.rank == 0:
-				print("Parallelization over paths and parameters\n Warning: You need to know what you are doing.")
-				print("In case you choose "+str(P.number_of_combinations)+" MPI ranks, the parallelization will be much more straightforward.")
-			Mpi.params_sets = int(Mpi.size/params.Nk2)
-			Mpi.color = Mpi.rank//params.Nk2
-			Mpi.mod = Mpi.rank%params.Nk2
-			Mpi.local_params_idx_list = list(range(P.number_of_combinations))[Mpi.color::Mpi.params_sets]
-			P.combined_parallelization = True
-			P.path_parallelization = True
+	# Parameter combinations of this shard (all combinations without sharding)
+	combinations = P.shard_combinations
+	if not combinations:
+		if Mpi.rank == 0:
+			print("Shard " + str(P.shard_index) + " of " + str(P.num_shards) + " has no parameter combinations.")
+		return []
+
+	# Every MPI rank runs its k-loops on num_threads numba threads
+	if P.num_threads > 1:
+		if P.num_threads > config.NUMBA_NUM_THREADS:
+			system.exit('num_threads can be at most ' + str(config.NUMBA_NUM_THREADS)
+						+ ', set NUMBA_NUM_THREADS to use more threads.')
+		set_num_threads(P.num_threads)
+
+	# Rank 0 derives and compiles the kernels, the other ranks load them from the caches
+	if P.compile_once and Mpi.size > 1:
+		warm_up_kernel_caches(sys, params, combinations[0], Mpi)
+
+	# Parallelize over paths and parameters if neither alone can use all ranks.
+	# The ranks are arranged on a (p_params, p_paths) grid chosen to minimize the
+	# predicted makespan; paths are split into uneven blocks if necessary.
+	if Mpi.size > params.Nk2 and Mpi.size > len(combinations) and not (P.parallelize_over_points or P.split_paths or P.split_k1) :
+		p_params, p_paths = Mpi.plan_params_paths_grid(len(combinations), params.Nk2)
+		if Mpi.rank == 0:
+			print("Parallelization over paths and parameters on a " + str(p_params) + " x "
+					+ str(p_paths) + " (parameters x paths) grid of MPI ranks.")
+			if p_params*p_paths < Mpi.size:
+				print(str(Mpi.size - p_params*p_paths) + " MPI ranks outside of the grid stay idle.")
+		Mpi.cart = Mpi.comm.Create_cart((p_params, p_paths))
+		Mpi.params_sets = p_params
+		Mpi.path_sets = p_paths
+		if Mpi.cart == Mpi.mpi.COMM_NULL:
+			# Ranks outside of the grid only take part in the final barrier
+			Mpi.color, Mpi.mod = None, None
+			Mpi.local_params_idx_list = []
 		else:
-			ncpu_list = []
-			for i in range(2, 1+P.number_of_combinations):
-				if P.number_of_combinations % (i) == 0:
-					ncpu_list.append(i*params.Nk2)
-			if Mpi.rank == 0:
-				print("For parallelization over paths and parameters, choose "
-						+ "the number of MPI ranks from " + str(ncpu_list) )
-			system.exit()
+			Mpi.color, Mpi.mod = Mpi.cart.Get_coords(Mpi.rank)
+			Mpi.local_params_idx_list = combinations[Mpi.color::Mpi.params_sets]
+		P.combined_parallelization = True
+		P.path_parallelization = True
 
 	# Parallelize over parameters if there are more parameter combinations than paths
-	elif (P.number_of_combinations >= params.Nk2 or P.path_list) and not (P.parallelize_over_points or P.split_paths):
+	elif (len(combinations) >= params.Nk2 or P.path_list) and not (P.parallelize_over_points or P.split_paths or P.split_k1):
 		Mpi.mod = None
-		Mpi.local_params_idx_list = Mpi.get_local_idx(P.number_of_combinations)
+		if P.dynamic_scheduling and Mpi.size > 1:
+			# Combinations differ in cost, rank 0 hands them out to free ranks
+			costs = [P.estimated_cost(i, params) for i in combinations]
+			Mpi.local_params_idx_list = (combinations[j] for j in Mpi.get_dynamic_idx(costs))
+			if Mpi.rank == 0:
+				# Rank 0 runs no combination itself but writes the screening data
+				P.distribute_parameters(combinations[0], params)
+		else:
+			Mpi.local_params_idx_list = [combinations[j] for j in Mpi.get_local_idx(len(combinations))]
 		P.path_parallelization = False
 
 	# Parallelize over paths else
 	else:
 		Mpi.mod = None
-		Mpi.local_params_idx_list = range(P.number_of_combinations)
+		Mpi.local_params_idx_list = combinations
 		P.path_parallelization = True
 
 	# make subcommunicator
@@ -85,23 +122,94 @@ def sbe_solver(sys, params):
 	make_subcommunicators(Mpi, P)
 
 	#run sbe for i'th parameter set
+	results = []
 	for i in Mpi.local_params_idx_list:
 		P.distribute_parameters(i, params)
-		run_sbe(sys, P, Mpi)
+		T, W = run_sbe(sys, P, Mpi)
+		if return_currents:
+			results.append(current_arrays(T, W))
 
 	# Wait until all calculations are finished.
 	if P.save_screening or P.save_latex_pdf:
 		write_screening_combinations_mpi(P, params, Mpi)
 
+	return results
+
+def warm_up_kernel_caches(sys, params, param_idx, Mpi):
+	'''
+	Rank 0 runs the symbolic derivation and the njit compilation on a copy of the
+	system, which fills the on-disk symbolic and kernel caches. The cache files are
+	broadcast afterwards, so ranks on nodes with their own cache directories find
+	them as well and no rank compiles the kernels again.
+	'''
+	files = None
+	if Mpi.rank == 0:
+		P = ParamsParser(params)
+		P.n = sys.n
+		P.n_sheets = 1
+		if hasattr(sys, 'n_sheets'):
+			P.n_sheets = sys.n_sheets
+		P.distribute_parameters(param_idx, params)
+		# Only the kernels are needed, neither the distribution of k-points nor Fock terms
+		P.parallelize_over_points = False
+		P.split_paths = False
+		P.split_k1 = False
+		P.do_fock = False
+		make_BZ(P, Mpi)
+		path = P.paths[0]
+
+		warm_up_sys = copy.deepcopy(sys)
+		warm_up_sys.eigensystem_dipole_path(path, P)
+		# The Coulomb kernel gets single distances, all other kernels k arrays along a
+		# path (strided columns of the path) and shifted, contiguous k arrays
+		kernels = vars(warm_up_sys)
+		compile_njit_kernels([kernel for name, kernel in kernels.items() if name != 'coulomb_matrix_jit'],
+		                     [path[:, 0], np.copy(path[:, 0])])
+		compile_njit_kernels([kernels.get('coulomb_matrix_jit')], [path[0, 0]])
+		if getattr(warm_up_sys, 'hfusedjit', None) is not None:
+			h_fused = np.empty((3, path[:, 0].size, P.n, P.n), dtype=P.type_complex_np)
+			# Strided and contiguous k arrays are compiled separately
+			warm_up_sys.hfusedjit(h_fused, kx=path[:, 0], ky=path[:, 1])
+			warm_up_sys.hfusedjit(h_fused, kx=np.copy(path[:, 0]), ky=np.copy(path[:, 1]))
+		files = read_cache_files(P.symbolic_cache)
+
+	files = Mpi.comm.bcast(files, root=0)
+	if Mpi.rank != 0:
+		write_cache_files(files)
+
+
+def compile_njit_kernels(objects, k_arguments):
+	'''
+	njit kernels only compile when they are called. Every kernel in objects (also
+	in nested lists) is called with each of k_arguments for all of its parameters,
+	which are k components (kx, ky, kxp, kyp) for the kernels of the systems.
+	'''
+	for obj in objects:
+		if isinstance(obj, (list, tuple)):
+			compile_njit_kernels(obj, k_arguments)
+		elif hasattr(obj, 'py_func') and hasattr(obj, 'compile'):
+			argnames = inspect.signature(obj.py_func).parameters.keys()
+			if 'out' in argnames:
+				# Fused kernels fill a workspace and are compiled separately
+				continue
+			for k_argument in k_arguments:
+				obj(**{argname: k_argument for argname in argnames})
+
+
 def make_subcommunicators(Mpi, P):
 
 	if P.combined_parallelization:
 
-		Mpi.subcomm = Mpi.comm.Split(Mpi.color, Mpi.rank)
-		Mpi.local_Nk2_idx_list = [Mpi.mod]
+		if Mpi.cart == Mpi.mpi.COMM_NULL:
+			# Idle rank outside of the grid
+			return
+
+		# Ranks sharing the parameter coordinate of the grid form the subcommunicator
+		Mpi.subcomm = Mpi.cart.Sub((False, True))
+		Mpi.local_Nk2_idx_list = np.array_split(np.arange(P.Nk2, dtype=np.int32), Mpi.path_sets)[Mpi.mod]
 
 	elif P.parallelize_over_points:	#works only for fixed Nk1 and Nk2
-		Mpi.local_Nk2_idx_list = Mpi.get_local_idx(P.Nk2*P.Nk1)
+		Mpi.local_Nk2_idx_list = Mpi.get_local_idx(P.Nk2*P.Nk1//P.points_per_block)
 		Mpi.subcomm = Mpi.comm.Split(0, Mpi.rank)
 
 	elif P.split_paths:
@@ -112,6 +220,16 @@ def make_subcommunicators(Mpi, P):
 		Mpi.local_Nk2_idx_list = Mpi.get_local_idx(P.split_order*P.Nk2)
 		Mpi.subcomm = Mpi.comm.Split(0, Mpi.rank)
 
+	elif P.split_k1:
+		if Mpi.size % P.Nk2 != 0:
+			system.exit('k1 can only be split if the number of ranks is an integer multiple of Nk2')
+		P.k1_segments = Mpi.size//P.Nk2
+
+		# Consecutive ranks hold the k1 segments of one path and exchange halos in k1comm
+		Mpi.k1comm = Mpi.comm.Split(Mpi.rank//P.k1_segments, Mpi.rank)
+		Mpi.local_Nk2_idx_list = [Mpi.rank//P.k1_segments]
+		Mpi.subcomm = Mpi.comm.Split(0, Mpi.rank)
+
 	elif P.path_parallelization:
 		Mpi.local_Nk2_idx_list = Mpi.get_local_idx(P.Nk2)
 		Mpi.subcomm = Mpi.comm.Split(0, Mpi.rank)
@@ -173,7 +291,7 @@ def run_sbe(sys, P, Mpi):
 
 	# Make rhs of ode for 2band or nband solver; returns 0 for series expansion
 	sys.eigensystem_dipole_path(P.paths[0], P) # change structure, such that hfjit gets calculated first
-	rhs_ode, solver = make_rhs_ode(P, T, sys)
+	rhs_ode, solver = make_rhs_ode(P, T, sys, Mpi)
 
 	# create array of initial occupation
 	rho_0 = np.zeros((P.Nk1, P.Nk2, P.n, P.n), dtype=P.type_complex_np)
@@ -186,71 +304,139 @@ def run_sbe(sys, P, Mpi):
 
 	T.densmat_container_fock = rho_0
 
+	if P.do_fock:
+		# Persistent buffers for the exchange of the local paths, received paths alternate
+		# between the two buffers such that the rhs can read one while the other is filled
+		T.fock_sendbuf = np.empty((len(Mpi.local_Nk2_idx_list), P.Nk1, P.n, P.n), dtype=P.type_complex_np)
+		T.fock_recvbuf = np.empty((2, P.Nk2, P.Nk1, P.n, P.n), dtype=P.type_complex_np)
+		T.fock_counts = Mpi.subcomm.allgather(T.fock_sendbuf.size)
+
+	if P.do_fock and P.fock_exchange == 'fft':
+		# The rhs gets the exchange sums of the density matrices instead of the matrices
+		T.fock_exchange = make_fock_exchange_fft(sys.v_k_kprime, P)
+		T.densmat_container_fock = T.fock_exchange(rho_0)
+
+	# Time steps without driving field that are propagated analytically
+	if P.fast_forward_field_free:
+		field_free = field_free_steps(T, P)
+
 	###########################################################################
 	# SOLVING
 	###########################################################################
-	# Iterate through each path in the Brillouin zone
-	for Nk2_idx in Mpi.local_Nk2_idx_list:
-		path = P.paths[Nk2_idx]
+	if P.batch_paths:
+		# Advance all local paths at once
+		solve_sbe_batched_paths(sys, P, T, Mpi, rhs_ode)
+	else:
+		# Iterate through each path in the Brillouin zone
+		for Nk2_idx in Mpi.local_Nk2_idx_list:
+			path = P.paths[Nk2_idx]
 
-		if P.user_out:
-			print('Solving SBE for Path', Nk2_idx+1)
+			if P.user_out:
+				print('Solving SBE for Path', Nk2_idx+1)
 
-		# Evaluate the dipole components along the path
-		sys.eigensystem_dipole_path(path, P)
+			# Evaluate the dipole components along the path
+			sys.eigensystem_dipole_path(path, P)
 
-		# Prepare calculations of observables
-		current_exact_path, polarization_inter_path, current_intra_path =\
-		    prepare_current_calculations(path, Nk2_idx, P, sys)
-
-		# Initialize the values of of each k point vector
-
-		y0, _buf = initial_condition(P, sys.e_in_path)
-		y0 = np.append(y0, [0.0, 0.0])
-
-		# Set the initual values and function parameters for the current kpath
-		if P.dm_dynamics_method in ('sbe', 'semiclassics'):
-			if P.solver_method in ('bdf', 'adams'):
-				solver.set_initial_value(y0, P.t0)\
-					.set_f_params(path, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path, y0, P.dk, T.densmat_container_fock, Nk2_idx)
-			elif P.solver_method == 'rk4':
-				T.solution_y_vec[:] = y0
-		elif P.dm_dynamics_method in ('series_expansion', 'EEA'):
-			T.solution_y_vec = np.copy(y0)
-			T.time_integral = np.zeros((P.Nk1, P.n, P.n), dtype=P.type_complex_np)
-		# Propagate through time
-		# Index of current integration time step
-		ti = 0
-		solver_successful = True
-
-		while solver_successful and ti < P.Nt:
-			# User output of integration progress
-			if (ti % (P.Nt//20) == 0 and P.user_out):
-				print('{:5.2f}%'.format((ti/P.Nt)*100))
-
-			calculate_solution_at_timestep(solver, Nk2_idx, ti, T, P, Mpi)
-
-			# Calculate the currents at the timestep ti
-			calculate_currents(Nk2_idx, ti, current_exact_path, polarization_inter_path, current_intra_path, T, P)
-
-			# Integrate one integration time step
-			if P.dm_dynamics_method in ('sbe', 'semiclassics'):
-				if P.solver_method in ('bdf', 'adams'):
-					solver.integrate(solver.t + P.dt)
-					solver_successful = solver.successful()
+			# Prepare calculations of observables
+			if P.jit_time_loop:
+				# The current kernel is part of the compiled loop, only its input depends on the path
+				path_data = current_exact_path_data(path, P, sys)
+			else:
+				current_exact_path, polarization_inter_path, current_intra_path =\
+				    prepare_current_calculations(path, Nk2_idx, P, sys)
 
-				elif P.solver_method == 'rk4':
-					T.solution_y_vec = rk_integrate(T.t[ti], T.solution_y_vec, path, sys,
-					                                y0, P.dk, P.dt, rhs_ode, T.densmat_container_fock, Nk2_idx)
+			# Initialize the values of of each k point vector
+
+			y0, _buf = initial_condition(P, sys.e_in_path)
+			y0 = np.append(y0, [0.0, 0.0])
 
+			# Set the initual values and function parameters for the current kpath
+			if P.dm_dynamics_method in ('sbe', 'semiclassics'):
+				if P.solver_method in ('bdf', 'adams', 'dopri5'):
+					solver.set_initial_value(y0, P.t0)\
+						.set_f_params(path, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path, y0, P.dk, T.densmat_container_fock, Nk2_idx)
+					if P.solver_method in ('bdf', 'adams') and P.jacobian == 'analytic':
+						solver.set_jac_params(path, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path, y0, P.dk, T.densmat_container_fock, Nk2_idx)
+					elif P.solver_method in ('bdf', 'adams') and P.jacobian == 'banded':
+						# zvode calls a banded Jacobian as jac(t, y), the path is bound in a closure
+						solver.jac = bind_jac_params(T.jac_ode, path, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path,
+						                             y0, P.dk, T.densmat_container_fock, Nk2_idx)
+				elif P.solver_method == 'rk4':
+					T.solution_y_vec[:] = y0
+					rk_workspace = make_rk_workspace(y0)
+				elif P.solver_method == 'etd_rk4':
+					T.solution_y_vec[:] = y0
+					# Energy phase and damping are integrated exactly by the exponential
+					L = diagonal_linear_part(sys.e_in_path, P)
+					etd_coefficients = etd_rk4_coefficients(L, P.dt)
+				elif P.solver_method == 'imex_rk3':
+					T.solution_y_vec[:] = y0
+					# Energy phase and damping are integrated implicitly, drift and field explicitly
+					L = diagonal_linear_part(sys.e_in_path, P)
+					imex_coefficients = imex_ars343_coefficients(L, P.dt)
 			elif P.dm_dynamics_method in ('series_expansion', 'EEA'):
-				T.solution_y_vec[:-2], T.time_integral = von_neumann_series(T.t[ti], T.A_field_in_path[ti], T.E_field_in_path[ti], path, sys, y0[:-2], T.time_integral, P, ti)
+				T.solution_y_vec = np.copy(y0)
+				T.time_integral = np.zeros((P.Nk1, P.n, P.n), dtype=P.type_complex_np)
+			if P.jit_time_loop:
+				# The compiled loop propagates the path from t0 to tf in a single call
+				propagate_path_jitted(solver, path_data, path, sys, y0, Nk2_idx, T, P, Mpi)
+				continue
+
+			# Propagate through time
+			# Index of current integration time step
+			ti = 0
+			solver_successful = True
+
+			while solver_successful and ti < P.Nt:
+				# User output of integration progress
+				if (ti % (P.Nt//20) == 0 and P.user_out):
+					print('{:5.2f}%'.format((ti/P.Nt)*100))
+
+				calculate_solution_at_timestep(solver, Nk2_idx, ti, T, P, Mpi)
+
+				if P.do_fock:
+					# The step ti -> ti+1 uses rho(ti-1), the exchange of rho(ti) runs meanwhile
+					if ti > 0:
+						finish_density_matrix_exchange(T, P, fock_request, ti-1)
+					fock_request = start_density_matrix_exchange(T, Mpi, ti)
+
+				# Calculate the currents at the timestep ti
+				calculate_currents(Nk2_idx, ti, current_exact_path, polarization_inter_path, current_intra_path, T, P)
+
+				# Integrate one integration time step
+				if P.dm_dynamics_method in ('sbe', 'semiclassics'):
+					if P.fast_forward_field_free and field_free[ti]:
+						# Free evolution is exact; L only changes when a field-free interval starts
+						if ti == 0 or not field_free[ti-1]:
+							y_eq, exp_L_dt = free_evolution_operator(T.t[ti], T.solution_y_vec, path, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path,
+							                                         y0, P.dk, P.dt, rhs_ode, T.densmat_container_fock, Nk2_idx)
+						T.solution_y_vec = y_eq + exp_L_dt*(T.solution_y_vec - y_eq)
+
+					elif P.solver_method in ('bdf', 'adams', 'dopri5'):
+						solver.integrate(solver.t + P.dt)
+						solver_successful = solver.successful()
+
+					elif P.solver_method == 'rk4':
+						A_stage = T.A_stage[:, 2*ti:2*ti+3] if P.precompute_fields else None
+						T.solution_y_vec = rk_integrate(T.t[ti], T.solution_y_vec, path, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path,
+						                                y0, P.dk, P.dt, rhs_ode, T.densmat_container_fock, Nk2_idx, rk_workspace, A_stage)
+
+					elif P.solver_method == 'etd_rk4':
+						T.solution_y_vec = etd_rk_integrate(T.t[ti], T.solution_y_vec, path, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path,
+						                                    y0, P.dk, P.dt, rhs_ode, T.densmat_container_fock, Nk2_idx, L, etd_coefficients)
+
+					elif P.solver_method == 'imex_rk3':
+						T.solution_y_vec = imex_rk_integrate(T.t[ti], T.solution_y_vec, path, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path,
+						                                     y0, P.dk, P.dt, rhs_ode, T.densmat_container_fock, Nk2_idx, L, imex_coefficients)
+
+				elif P.dm_dynamics_method in ('series_expansion', 'EEA'):
+					T.solution_y_vec[:-2], T.time_integral = von_neumann_series(T.t[ti], T.A_field_in_path[ti], T.E_field_in_path[ti], path, sys, y0[:-2], T.time_integral, P, ti)
+
+				# Increment time counter
+				ti += 1
 
 			if P.do_fock:
-				mpi_sum_density_matrix(T, P, Mpi, Nk2_idx, ti)
-
-			# Increment time counter
-			ti += 1
+				fock_request.Wait()
 
 	# in case of MPI-parallel execution: mpi sum
 	mpi_sum_currents(T, P, Mpi)
@@ -263,20 +449,21 @@ def run_sbe(sys, P, Mpi):
 	update_currents_with_kweight(T, P)
 	if not P.only_save_time_data:
 		calculate_fourier(T, P, W)
-	write_current_emission_mpi(T, P, W, sys, Mpi)
-
-	# Save the parameters of the calculation
-	params_name = P.header + 'params.txt'
-	paramsfile = open(params_name, 'w')
-	paramsfile.write("Runtime: {:.16f} s \n\n".format(P.run_time))
-	exceptions = {'__weakref__', '__doc__', '__dict__', '__module__', \
-	              '_ParamsParser__user_defined_field', 'header', 'mesh', 'number_of_combinations', \
-	              'params_combinations', 'params_lists', 'path_list', 'paths', 'run_time', \
-	              't_pdf_densmat', 'type_complex_np', 'type_real_np', 'user_params'}
-	for key in sorted(P.__dict__.keys() - exceptions):
-		paramsfile.write(str(key) + ' = ' + str(P.__dict__[key]) + "\n")
-
-	paramsfile.close()
+	if P.save_output:
+		write_current_emission_mpi(T, P, W, sys, Mpi)
+
+		# Save the parameters of the calculation
+		params_name = P.header + 'params.txt'
+		paramsfile = open(params_name, 'w')
+		paramsfile.write("Runtime: {:.16f} s \n\n".format(P.run_time))
+		exceptions = {'__weakref__', '__doc__', '__dict__', '__module__', \
+		              '_ParamsParser__user_defined_field', 'header', 'mesh', 'number_of_combinations', \
+		              'params_combinations', 'params_lists', 'path_list', 'paths', 'run_time', \
+		              't_pdf_densmat', 'type_complex_np', 'type_real_np', 'user_params'}
+		for key in sorted(P.__dict__.keys() - exceptions):
+			paramsfile.write(str(key) + ' = ' + str(P.__dict__[key]) + "\n")
+
+		paramsfile.close()
 
 	if P.save_full:
 		# write_full_density_mpi(T, P, sys, Mpi)
@@ -289,6 +476,23 @@ def run_sbe(sys, P, Mpi):
 		np.savez(P.header + 'time_matrix', pdf_densmat=T.pdf_densmat,
 			 t_pdf_densmat=T.t_pdf_densmat, A_field=T.A_field_in_path)
 
+	return T, W
+
+
+def current_arrays(T, W):
+	'''
+	Time-dependent currents and fields of a run and, if calculated, the emission
+	spectra as a dictionary of arrays (in-memory counterpart of the data files)
+	'''
+	currents = {'t': T.t, 'E_field_in_path': T.E_field_in_path, 'E_field_ortho': T.E_field_ortho,
+	            'A_field_in_path': T.A_field_in_path, 'A_field_ortho': T.A_field_ortho,
+	            'j_E_dir': T.j_E_dir, 'j_ortho': T.j_ortho}
+	if hasattr(W, 'freq'):
+		currents.update({'freq': W.freq, 'j_E_dir_freq': W.j_E_dir, 'j_ortho_freq': W.j_ortho,
+		                 'I_E_dir': W.I_E_dir, 'I_ortho': W.I_ortho})
+
+	return currents
+
 
 def make_BZ(P, Mpi):
 		# Form Brillouin Zone
@@ -317,13 +521,19 @@ def make_BZ(P, Mpi):
 		P.Nk2_buf = np.copy(P.Nk2)
 		paths_buf = np.copy(P.paths)
 
-		P.paths = np.empty((P.Nk1_buf*P.Nk2_buf, 1, 2))
+		# The k-points are independent in velocity gauge, every block of
+		# points_per_block points is propagated as one system
+		number_of_points = P.Nk1_buf*P.Nk2_buf
+		if number_of_points % P.points_per_block != 0:
+			system.exit('points_per_block has to divide the number of k-points Nk1*Nk2')
+		points = np.empty((number_of_points, 2))
 		for j in range(P.Nk1_buf):
 			for i in range(P.Nk2_buf):
-				P.paths[j + P.Nk1_buf*i, 0, 0] = paths_buf[i, j, 0]
-				P.paths[j + P.Nk1_buf*i, 0, 1] = paths_buf[i, j, 1]
-		P.Nk1 = 1
-		P.Nk2 = P.Nk1_buf * P.Nk2_buf
+				points[j + P.Nk1_buf*i, 0] = paths_buf[i, j, 0]
+				points[j + P.Nk1_buf*i, 1] = paths_buf[i, j, 1]
+		P.paths = points.reshape(number_of_points//P.points_per_block, P.points_per_block, 2)
+		P.Nk1 = P.points_per_block
+		P.Nk2 = number_of_points//P.points_per_block
 
 	elif P.split_paths:
 		if P.gauge != 'velocity':
@@ -346,22 +556,62 @@ def make_BZ(P, Mpi):
 						P.paths[P.split_order * ky_idx_old + o, kx_idx_old - o * P.Nk1 , 0] = paths_buf[ky_idx_old, kx_idx_old, 0]
 						P.paths[P.split_order * ky_idx_old + o, kx_idx_old - o * P.Nk1 , 1] = paths_buf[ky_idx_old, kx_idx_old, 1]
 
-def make_rhs_ode(P, T, sys):
+	elif P.split_k1:
+		if P.Nk1 % P.k1_segments != 0:
+			system.exit('k1 can only be split if Nk1 is divisible by Mpi.size/Nk2')
+		P.Nk1_buf = np.copy(P.Nk1)
+		P.Nk1 = int(P.Nk1_buf/P.k1_segments)
+		if P.Nk1 < P.dk_order//2:
+			system.exit('Every k1 segment needs at least dk_order/2 points for the halo exchange')
+
+		# Every rank keeps its own segment of the paths, dk and kweight belong to the full path
+		segment = Mpi.k1comm.Get_rank()
+		P.paths = P.paths[:, segment*P.Nk1:(segment+1)*P.Nk1, :]
+
+def make_rhs_ode(P, T, sys, Mpi):
 
 	if P.dm_dynamics_method in ('sbe', 'semiclassics'):
+		electric_field_in_path = T.electric_field_in_path
+		electric_field_ortho = T.electric_field_ortho
+		if P.precompute_fields:
+			# E and A once on the rk4 stage grid, the rhs only looks E up
+			E_stage_in_path, A_stage_in_path = make_stage_field_table(T.electric_field_in_path, P)
+			E_stage_ortho, A_stage_ortho = make_stage_field_table(T.electric_field_ortho, P)
+			T.A_stage = np.array([A_stage_in_path, A_stage_ortho])
+			electric_field_in_path = make_stage_field_lookup(E_stage_in_path, P)
+			electric_field_ortho = make_stage_field_lookup(E_stage_ortho, P)
+
 		if P.solver == '2band':
 			if P.n != 2:
 				raise AttributeError('2-band solver works for 2-band systems only')
 			else:
-				rhs_ode = make_rhs_ode_2_band(sys, T.electric_field_in_path, T.electric_field_ortho, P)
+				rhs_ode = make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P)
 
 		elif P.solver == 'nband':
-			rhs_ode = make_rhs_ode_n_band(sys, T.electric_field_in_path, T.electric_field_ortho, P)
+			rhs_ode = make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P)
 		else:
 			rhs_ode = 0
 
+		if P.split_k1:
+			# The stencil reaches into the segments of the neighbouring ranks
+			rhs_ode = make_rhs_ode_halo(rhs_ode, Mpi.exchange_halos, P)
+
 		if P.solver_method in ('bdf', 'adams'):
-			solver = ode(rhs_ode, jac=None).set_integrator('zvode', method=P.solver_method, max_step=P.dt)
+			max_step = P.dt if P.max_step is None else P.max_step
+			if P.jacobian in (None, 'numeric'):
+				solver = ode(rhs_ode, jac=None).set_integrator('zvode', method=P.solver_method, max_step=max_step,
+				                                              rtol=P.rtol, atol=P.atol, with_jacobian=P.jacobian == 'numeric')
+			else:
+				jac_ode = make_jac_ode_length(T.electric_field_in_path, P)
+				T.jac_ode = jac_ode
+				lband, uband = jacobian_bandwidth(P) if P.jacobian == 'banded' else (None, None)
+				solver = ode(rhs_ode, jac=jac_ode).set_integrator('zvode', method=P.solver_method, max_step=max_step,
+				                                                 rtol=P.rtol, atol=P.atol, lband=lband, uband=uband)
+		elif P.solver_method == 'dopri5':
+			solver = Dopri5Solver(rhs_ode, P)
+		elif P.jit_time_loop:
+			current_exact_kernel = make_current_exact_kernel(P, sys)
+			solver = make_rk4_time_loop(rhs_ode, current_exact_kernel, T.electric_field_in_path, T.electric_field_ortho, P)
 		else:
 			solver = 0
 
@@ -410,12 +660,52 @@ def prepare_current_calculations(path, Nk2_idx, P, sys):
 	return current_exact_path, polarization_inter_path, current_intra_path
 
 
+def make_current_exact_kernel(P, sys):
+	"""
+	Path independent exact current kernel of the compiled time loop (jit_time_loop),
+	the path enters via current_exact_path_data.
+	"""
+	if sys.system == 'ana':
+		if P.gauge == 'length':
+			return make_current_exact_kernel_length(P, sys)
+		if P.gauge == 'velocity':
+			return make_current_exact_kernel_velocity(P, sys)
+	elif sys.system == 'num':
+		if P.gauge == 'length':
+			return make_current_exact_kernel_hderiv_length(P, sys)
+		if P.gauge == 'velocity':
+			system.exit('jit_time_loop needs the length gauge for numerical Hamiltonians')
+	else:
+		if P.gauge == 'length':
+			return make_current_exact_kernel_bandstructure(P, sys)
+		elif P.gauge == 'velocity':
+			return make_current_exact_kernel_bandstructure_velocity(P, sys)
+
+
+def current_exact_path_data(path, P, sys):
+	"""
+	Path dependent input of the kernel from make_current_exact_kernel.
+	"""
+	if sys.system == 'ana':
+		if P.gauge == 'length':
+			return current_exact_path_data_length(path, P, sys)
+		if P.gauge == 'velocity':
+			return current_exact_path_data_velocity(path, P, sys)
+	elif sys.system == 'num':
+		return current_exact_path_data_hderiv_length(path, P, sys)
+	else:
+		if P.gauge == 'length':
+			return current_exact_path_data_bandstructure(path, P, sys)
+		elif P.gauge == 'velocity':
+			return current_exact_path_data_bandstructure_velocity(path, P, sys)
+
+
 def calculate_solution_at_timestep(solver, Nk2_idx, ti, T, P, Mpi):
 
 	is_first_Nk2_idx = (Mpi.local_Nk2_idx_list[0] == Nk2_idx)
 
 	if P.dm_dynamics_method in ('sbe', 'semiclassics'):
-		if P.solver_method in ('bdf', 'adams'):
+		if P.solver_method in ('bdf', 'adams', 'dopri5'):
 			# Do not append the last 2 elements (A_field_ortho and A_field_in_path)
 			T.solution = solver.y[:-2].reshape(P.Nk1, P.n, P.n)
 
@@ -428,7 +718,7 @@ def calculate_solution_at_timestep(solver, Nk2_idx, ti, T, P, Mpi):
 				T.E_field_in_path[ti] = T.electric_field_in_path(T.t[ti])
 				T.E_field_ortho[ti] = T.electric_field_ortho(T.t[ti])
 
-		elif P.solver_method == 'rk4':
+		elif P.solver_method in ('rk4', 'etd_rk4', 'imex_rk3'):
 			# Do not append the last element (A_field)
 			T.solution = T.solution_y_vec[:-2].reshape(P.Nk1, P.n, P.n)
 
@@ -489,17 +779,287 @@ def calculate_currents(Nk2_idx, ti, current_exact_path, polarization_inter_path,
 		T.j_intra_ortho[ti] += j_intra_ortho_buf
 		T.j_anom_ortho[ti, :] += j_anom_ortho_buf
 
-def rk_integrate(t, y, kpath, sys, y0, dk, dt, rhs_ode, rho, Nk2_idx):
-
-	k1 = rhs_ode(t,          y,          kpath, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path, y0, dk, rho, Nk2_idx)
-	k2 = rhs_ode(t + 0.5*dt, y + 0.5*k1, kpath, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path, y0, dk, rho, Nk2_idx)
-	k3 = rhs_ode(t + 0.5*dt, y + 0.5*k2, kpath, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path, y0, dk, rho, Nk2_idx)
-	k4 = rhs_ode(t +     dt, y +     k3, kpath, sys.dipole_in_path, sys.dipole_ortho, sys.e_in_path, y0, dk, rho, Nk2_idx)
+def rk_integrate(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, dt, rhs_ode, rho, Nk2_idx, workspace=None, A_stage=None):
+	"""
+	Runge-Kutta 4 step. If the vector potential is tabulated on the stage grid, A_stage
+	holds its in-path and ortho components at t, t + dt/2 and t + dt (shape (2, 3)); the
+	stages then carry the exact vector potential, so k2 and k3 see the same shifted k-grid.
+	"""
+	if workspace is not None:
+		return rk_integrate_workspace(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, dt, rhs_ode, rho, Nk2_idx, workspace, A_stage)
+
+	k1 = rhs_ode(t,          y,          kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+	y2 = y + 0.5*k1
+	if A_stage is not None:
+		y2[-2:] = A_stage[:, 1]
+	k2 = rhs_ode(t + 0.5*dt, y2,         kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+	y3 = y + 0.5*k2
+	if A_stage is not None:
+		y3[-2:] = A_stage[:, 1]
+	k3 = rhs_ode(t + 0.5*dt, y3,         kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+	y4 = y + k3
+	if A_stage is not None:
+		y4[-2:] = A_stage[:, 2]
+	k4 = rhs_ode(t +     dt, y4,         kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
 
 	ynew = y + dt/6 * (k1 + 2*k2 + 2*k3 + k4)
+	if A_stage is not None:
+		ynew[-2:] = A_stage[:, 2]
+
+	return ynew
+
+
+def make_rk_workspace(y):
+	"""
+	Preallocated arrays for rk_integrate: the four stages, the stage argument and
+	the buffer of the new solution vector.
+	"""
+	return [np.empty_like(y) for _i in range(6)]
+
+
+def rk_integrate_workspace(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, dt, rhs_ode, rho, Nk2_idx, workspace, A_stage=None):
+	"""
+	Same step as rk_integrate (bitwise identical result) without temporary arrays. The
+	new solution is written to workspace[5]; y is kept unchanged (T.solution is a view
+	of it) and takes the place of workspace[5] for the next step.
+	"""
+	k1, k2, k3, k4, y_stage, ynew = workspace
+
+	rhs_ode(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, k1)
+	np.multiply(k1, 0.5, out=y_stage)
+	y_stage += y
+	if A_stage is not None:
+		y_stage[-2:] = A_stage[:, 1]
+	rhs_ode(t + 0.5*dt, y_stage, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, k2)
+	np.multiply(k2, 0.5, out=y_stage)
+	y_stage += y
+	if A_stage is not None:
+		y_stage[-2:] = A_stage[:, 1]
+	rhs_ode(t + 0.5*dt, y_stage, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, k3)
+	np.add(y, k3, out=y_stage)
+	if A_stage is not None:
+		y_stage[-2:] = A_stage[:, 2]
+	rhs_ode(t + dt, y_stage, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, k4)
+
+	# ynew = y + dt/6 * (k1 + 2*k2 + 2*k3 + k4)
+	np.multiply(k2, 2, out=y_stage)
+	y_stage += k1
+	k3 *= 2
+	y_stage += k3
+	y_stage += k4
+	y_stage *= dt/6
+	np.add(y, y_stage, out=ynew)
+	if A_stage is not None:
+		ynew[-2:] = A_stage[:, 2]
+
+	workspace[5] = y
 
 	return ynew
 
+
+def field_free_steps(T, P):
+	"""
+	Marks the time steps ti -> ti+1 during which both components of the driving field
+	stay below P.field_free_tol at all Runge-Kutta stage times t, t + dt/2, t + dt.
+	"""
+	field_free = np.zeros(P.Nt, dtype=bool)
+	for ti in range(P.Nt):
+		t = P.t0 + ti*P.dt
+		field_free[ti] = all(abs(T.electric_field_in_path(t_stage)) <= P.field_free_tol
+		                     and abs(T.electric_field_ortho(t_stage)) <= P.field_free_tol
+		                     for t_stage in (t, t + 0.5*P.dt, t + P.dt))
+	return field_free
+
+
+def free_evolution_operator(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, dt, rhs_ode, rho, Nk2_idx):
+	"""
+	Without driving field the SBE decouple into y' = L*(y - y_eq) with a diagonal L
+	(band energy phase and T1/T2 damping), where y_eq is the initial occupation y0 at
+	the current vector potential. L is read off from two calls of rhs_ode, so it also
+	contains the A-shifted band energies of the velocity gauge.
+
+	Returns
+	-------
+	y_eq : np.ndarray
+	    Equilibrium solution vector
+	exp_L_dt : np.ndarray
+	    Diagonal free propagator of one time step
+	"""
+	y_eq = np.copy(y0)
+	y_eq[-2:] = y[-2:]
+	y_probe = y_eq + 1
+	y_probe[-2:] = y[-2:]
+
+	L = rhs_ode(t, y_probe, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx) \
+	    - rhs_ode(t, y_eq, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+
+	return y_eq, np.exp(L*dt)
+
+
+def etd_rk_integrate(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, dt, rhs_ode, rho, Nk2_idx, L, etd_coefficients):
+	"""
+	Exponential time differencing Runge-Kutta 4 step (Cox and Matthews). The diagonal
+	linear part L of the SBE (band energy phase and T1/T2 damping) is integrated exactly,
+	only the remainder N(t, y) = rhs_ode(t, y) - L*(y - y0), i.e. the field coupling, is
+	approximated. The step size is thus not limited by the band gap.
+	"""
+	exp_L_dt, exp_L_half_dt, Q, f1, f2, f3 = etd_coefficients
+
+	def N(t, u):
+		return rhs_ode(t, y0 + u, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx) - L*u
+
+	u = y - y0
+	Nu = N(t, u)
+	a = exp_L_half_dt*u + Q*Nu
+	Na = N(t + 0.5*dt, a)
+	b = exp_L_half_dt*u + Q*Na
+	Nb = N(t + 0.5*dt, b)
+	c = exp_L_half_dt*a + Q*(2*Nb - Nu)
+	Nc = N(t + dt, c)
+
+	unew = exp_L_dt*u + f1*Nu + 2*f2*(Na + Nb) + f3*Nc
+
+	return y0 + unew
+
+
+def imex_rk_integrate(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, dt, rhs_ode, rho, Nk2_idx, L, imex_coefficients):
+	"""
+	Implicit-explicit Runge-Kutta step (ARS(3,4,3)). The diagonal linear part L of the SBE
+	(band energy phase and T1/T2 damping) is treated implicitly, which is a closed-form
+	division per entry. The remainder N(t, y) = rhs_ode(t, y) - L*(y - y0), i.e. the
+	k-derivative drift and the field coupling, is treated explicitly. The step is thus
+	stable for short dephasing times at the cost of four rhs_ode calls.
+	"""
+	A_im, A_ex, b, c, inv_stage = imex_coefficients
+
+	def N(t, u):
+		return rhs_ode(t, y0 + u, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx) - L*u
+
+	u = y - y0
+	stages = b.size
+	NU = [None]*stages
+	LU = [None]*stages
+
+	U = u
+	for i in range(stages):
+		if i > 0:
+			r = u + dt*sum(A_ex[i, j]*NU[j] + A_im[i, j]*LU[j] for j in range(i))
+			U = inv_stage*r
+		NU[i] = N(t + c[i]*dt, U)
+		LU[i] = L*U
+
+	unew = u + dt*sum(b[j]*(NU[j] + LU[j]) for j in range(stages))
+
+	return y0 + unew
+
+
+def solve_sbe_batched_paths(sys, P, T, Mpi, rhs_ode):
+	"""
+	Runge-Kutta 4 propagation of all paths of the current MPI rank at once.
+	The solution vectors of the local paths are stacked to an array of shape
+	(Nk2_local, Nk1*n*n + 2) and every Runge-Kutta stage evaluates the right
+	hand side of all paths in a single call of the batched rhs_ode. The exact
+	currents of all paths are evaluated in a single compiled call per time step.
+
+	Parameters
+	----------
+	sys : class
+	    Symbolic Hamiltonian of the system
+	P : class
+	    Default parameters combined with user parameters from the params.py file
+	T : class
+	    Time-dependent containers, the currents of all local paths are added up
+	Mpi : class
+	    Information needed for MPI-parallel runs
+	rhs_ode : function
+	    Batched right hand side from make_rhs_ode_batch
+	"""
+	Nk2_idx_list = np.array(Mpi.local_Nk2_idx_list, dtype=np.int64)
+	Nk2_local = Nk2_idx_list.size
+	if Nk2_local == 0:
+		return
+
+	kpaths = P.paths[Nk2_idx_list]
+	dipole_in_path = np.empty((Nk2_local, P.Nk1, P.n, P.n), dtype=P.type_complex_np)
+	dipole_ortho = np.empty((Nk2_local, P.Nk1, P.n, P.n), dtype=P.type_complex_np)
+	e_in_path = np.empty((Nk2_local, P.Nk1, P.n), dtype=P.type_real_np)
+	y0 = np.zeros((Nk2_local, P.Nk1*P.n**2 + 2), dtype=P.type_complex_np)
+	path_data = []
+
+	# Collect the band data, observables and initial conditions of every local path
+	for p, Nk2_idx in enumerate(Nk2_idx_list):
+		path = P.paths[Nk2_idx]
+
+		if P.user_out:
+			print('Solving SBE for Path', Nk2_idx+1)
+
+		sys.eigensystem_dipole_path(path, P)
+		dipole_in_path[p] = sys.dipole_in_path
+		dipole_ortho[p] = sys.dipole_ortho
+		e_in_path[p] = sys.e_in_path
+
+		path_data.append(current_exact_path_data(path, P, sys))
+
+		y0[p, :-2], _buf = initial_condition(P, sys.e_in_path)
+
+	# One compiled call per time step evaluates the currents of all local paths
+	current_exact_batch = make_current_exact_batch(make_current_exact_kernel(P, sys), P)
+	path_data = tuple(path_data)
+
+	y = np.copy(y0)
+	rk_workspace = make_rk_workspace(y)
+
+	for ti in range(P.Nt):
+		# User output of integration progress
+		if (ti % (P.Nt//20) == 0 and P.user_out):
+			print('{:5.2f}%'.format((ti/P.Nt)*100))
+
+		# Time and fields are shared by all paths
+		T.t[ti] = ti*P.dt + P.t0
+		T.A_field_in_path[ti] = y[0, -2].real
+		T.A_field_ortho[ti] = y[0, -1].real
+		T.E_field_in_path[ti] = T.electric_field_in_path(T.t[ti])
+		T.E_field_ortho[ti] = T.electric_field_ortho(T.t[ti])
+
+		# Density matrices of all local paths, shape (Nk2_local, Nk1, n, n)
+		solution = y[:, :-2].reshape(Nk2_local, P.Nk1, P.n, P.n)
+
+		if P.save_full:
+			T.solution_full[:, Nk2_idx_list, ti, :, :] = np.swapaxes(solution, 0, 1)
+
+		if P.save_latex_pdf or P.save_dm_t:
+			T.solution = np.swapaxes(solution, 0, 1)
+			store_density_matrix_for_pdf(T, P, Nk2_idx_list, ti)
+
+		# Currents of all local paths at the timestep ti
+		j_E_dir_buf, j_ortho_buf = current_exact_batch(solution, T.E_field_in_path[ti], T.E_field_ortho[ti],
+		                                               T.A_field_in_path[ti], T.A_field_ortho[ti], path_data)
+		T.j_E_dir[ti] += j_E_dir_buf
+		T.j_ortho[ti] += j_ortho_buf
+
+		y = rk_integrate(T.t[ti], y, kpaths, dipole_in_path, dipole_ortho, e_in_path,
+		                 y0, P.dk, P.dt, rhs_ode, T.densmat_container_fock, Nk2_idx_list, rk_workspace)
+
+def propagate_path_jitted(rk4_time_loop, path_data, path, sys, y0, Nk2_idx, T, P, Mpi):
+	"""
+	Propagate a single path with the compiled Runge-Kutta 4 time loop from make_rk4_time_loop.
+	"""
+	is_first_Nk2_idx = (Mpi.local_Nk2_idx_list[0] == Nk2_idx)
+
+	if P.save_latex_pdf or P.save_dm_t:
+		pdf_densmat_path = T.pdf_densmat[:, Nk2_idx, :, :, :]
+		t_pdf_densmat_stored = T.t_pdf_densmat
+	else:
+		pdf_densmat_path = np.zeros((0, 0, P.n, P.n), dtype=P.type_complex_np)
+		t_pdf_densmat_stored = np.zeros(0)
+
+	T.solution_y_vec = rk4_time_loop(path_data, T.solution_y_vec, path, sys.dipole_in_path, sys.dipole_ortho,
+	                                 sys.e_in_path, y0, P.dk, T.densmat_container_fock, Nk2_idx, is_first_Nk2_idx,
+	                                 T.t, T.A_field_in_path, T.A_field_ortho, T.E_field_in_path, T.E_field_ortho,
+	                                 T.j_E_dir, T.j_ortho, P.t_pdf_densmat, pdf_densmat_path, t_pdf_densmat_stored)
+	T.solution = T.solution_y_vec[:-2].reshape(P.Nk1, P.n, P.n)
+
+
 @njit
 def y0deriv(y, dk, Nk_path, n, dk_order, type_complex_np):
 
@@ -557,6 +1117,16 @@ def y0deriv(y, dk, Nk_path, n, dk_order, type_complex_np):
 
 	return diffy0
 
+def y0deriv_spectral(y, dk, n):
+	"""
+	Spectral counterpart of y0deriv for dk_order = 'spectral'
+	"""
+	diffy0 = np.zeros(np.shape(y), dtype=y.dtype)
+	for i in range(n):
+		diffy0[:, i, i] = spectral_k_derivative(y[:, i, i]) / dk
+
+	return diffy0
+
 def von_neumann_series(t, A_field, E_field, path, sys, y0, time_integral, P, ti):
 
 	# rescale solution vector and initial condition to be a matrix
@@ -587,7 +1157,10 @@ def von_neumann_series(t, A_field, E_field, path, sys, y0, time_integral, P, ti)
 
 		if P.gauge == 'length':
 			if ti == 0:
-				P.diffy0 = y0deriv(y0_mat, P.dk, P.Nk1, P.n, P.dk_order, P.type_complex_np)
+				if P.dk_order == 'spectral':
+					P.diffy0 = y0deriv_spectral(y0_mat, P.dk, P.n)
+				else:
+					P.diffy0 = y0deriv(y0_mat, P.dk, P.Nk1, P.n, P.dk_order, P.type_complex_np)
 
 		if P.first_order:
 			if P.high_damping:
@@ -754,17 +1327,40 @@ def parzen(t):
 
 	return parzen
 
-def mpi_sum_density_matrix(T, P, Mpi, Nk2_idx, ti):
+def start_density_matrix_exchange(T, Mpi, ti):
+	"""
+	Starts the nonblocking gather of the density matrices of the local paths at time step
+	ti from all ranks. Only the local slices are communicated, the ranks own consecutive
+	path indices.
 
-	T.densmat_container_fock = np.zeros((P.Nk1, P.Nk2, P.n, P.n), dtype=P.type_complex_np)
+	Returns
+	-------
+	request : MPI.Request
+	    Has to be completed by finish_density_matrix_exchange
+	"""
+	# Each rank solves a single path in Fock calculations
+	T.fock_sendbuf[0] = T.solution
+
+	return Mpi.iallgather_paths(T.fock_sendbuf, T.fock_recvbuf[ti % 2], T.fock_counts)
 
-	local_array = np.zeros((P.Nk1, P.Nk2, P.n, P.n), dtype=P.type_complex_np)
-	local_array[:, Nk2_idx, :, :] = T.solution
+def finish_density_matrix_exchange(T, P, request, ti):
+	"""
+	Waits for the density matrices of time step ti and hands them to the rhs, as
+	exchange sums if fock_exchange == 'fft'.
+	"""
+	request.Wait()
+
+	T.densmat_container_fock = T.fock_recvbuf[ti % 2].transpose(1, 0, 2, 3)
 
-	T.densmat_container_fock = Mpi.sync_and_sum(local_array)
+	if P.fock_exchange == 'fft':
+		T.densmat_container_fock = T.fock_exchange(T.densmat_container_fock)
 
 def mpi_sum_currents(T, P, Mpi):
 
+	if P.current_reduction == 'reduce':
+		mpi_reduce_currents_packed(T, P, Mpi)
+		return
+
 	T.j_E_dir       = Mpi.sync_and_sum(T.j_E_dir)
 	T.j_ortho       = Mpi.sync_and_sum(T.j_ortho)
 	if P.split_current:
@@ -776,6 +1372,29 @@ def mpi_sum_currents(T, P, Mpi):
 	if P.save_latex_pdf or P.save_dm_t:
 		T.pdf_densmat   = Mpi.sync_and_sum(T.pdf_densmat)
 
+def mpi_reduce_currents_packed(T, P, Mpi):
+	'''
+	Sums the currents of the subcommunicator onto its writing rank (rank 0 of the
+	subcommunicator) with a single Reduce of one packed buffer. All other ranks
+	keep their local currents.
+	'''
+	names = ['j_E_dir', 'j_ortho']
+	if P.split_current:
+		names += ['j_intra_E_dir', 'j_intra_ortho', 'P_E_dir', 'P_ortho', 'j_anom_ortho']
+	if P.save_latex_pdf:
+		names += ['pdf_densmat']
+
+	# Complex arrays are packed as pairs of real numbers
+	arrays = [np.ascontiguousarray(getattr(T, name)) for name in names]
+	packed = np.concatenate([array.view(P.type_real_np).ravel() for array in arrays])
+	Mpi.reduce_in_place(packed)
+
+	offset = 0
+	for name, array in zip(names, arrays):
+		size = array.nbytes//packed.itemsize
+		setattr(T, name, packed[offset:offset+size].view(array.dtype).reshape(array.shape))
+		offset += size
+
 def update_currents_with_kweight(T, P):
 
 	T.j_E_dir *= P.kweight
@@ -944,11 +1563,51 @@ def calculate_fourier(T, P, W):
 #     full_density_header = dens_header + cohe_header
 #     full_density
 
+def merge_shards(params, shard_dirs=None):
+	'''
+	Combine the outputs of a sharded run (shard_index/num_shards or CUED_SHARD_INDEX/
+	CUED_NUM_SHARDS) in the current directory and write the screening data a single
+	run would produce. shard_dirs lists the working directories of the shards if
+	they did not run in the current directory.
+	'''
+	# Only rank 0 merges if called from an MPI job
+	Mpi = MpiHelpers()
+	Mpi.comm.Barrier()
+	if Mpi.rank != 0:
+		return
+
+	if shard_dirs is not None:
+		for shard_dir in sorted(shard_dirs):
+			for filename in sorted(os.listdir(shard_dir)):
+				filepath = os.path.join(shard_dir, filename)
+				if os.path.isfile(filepath) and not os.path.exists(filename):
+					shutil.copy2(filepath, filename)
+
+	P = ParamsParser(params)
+	P.distribute_parameters(0, params)
+
+	# Every combination has to be computed by one of the shards. The frequency
+	# data is written last, unless only the time data is saved
+	last_output = 'time_data.dat' if P.only_save_time_data else 'frequency_data.dat'
+	missing = []
+	for i in range(P.number_of_combinations):
+		P.construct_current_parameters_and_header(i, params)
+		if not os.path.isfile(P.header + last_output):
+			missing.append(i)
+	if missing:
+		system.exit("Missing output of parameter combinations " + str(missing) + ", not all shards are finished.")
+
+	if P.number_of_combinations > 1 and (P.save_screening or P.save_latex_pdf):
+		write_screening_combinations(P, params)
+
 def write_screening_combinations_mpi(P, params, Mpi):
 	# Wait until all jobs are finished
 	Mpi.comm.Barrier()
 	if Mpi.rank == 0 and P.number_of_combinations > 1:
-		write_screening_combinations(P, params)
+		if P.num_shards > 1:
+			print("Screening data of sharded runs is written by merge_shards after all shards are finished.")
+		else:
+			write_screening_combinations(P, params)
 
 def write_screening_combinations(P, params):
 	'''
@@ -1043,6 +1702,8 @@ def write_screening_combinations(P, params):
 							   np.hstack((s.ff0[:, np.newaxis], s.screening_output.T)),
 							   header=screening_file_header, delimiter=' '*3, fmt="%+.18e")
 			if P.save_latex_pdf:
+				# The plotting stack is only imported when PDFs are requested
+				from cued.plotting import write_and_compile_screening_latex_PDF
 				write_and_compile_screening_latex_PDF(S)
 			chdir()
 
@@ -1201,6 +1862,8 @@ def write_current_emission(T, P, W, sys, Mpi):
 		if P.save_latex_pdf:
 			if P.parallelize_over_points:
 				print("WARNING: Parallelization over points causes problems when printing the PDF. Usage of other parallelization methods is recommended.")
+			# The plotting stack is only imported when PDFs are requested
+			from cued.plotting import write_and_compile_latex_PDF
 			write_and_compile_latex_PDF(T, W, P, sys, Mpi)
 
 
@@ -1,6 +1,7 @@
 import numpy as np
 import numpy.linalg as lin
 from cued.utility import ConversionFactors as co
+from numba import prange
 from cued.utility import conditional_njit, evaluate_njit_matrix
 
 
@@ -223,6 +224,29 @@ def make_current_exact_path_velocity(path, P, sys):
 	current_kernel : function
 	    Calculates per timestep current of a path
 	"""
+	current_exact_kernel = make_current_exact_kernel_velocity(P, sys)
+	path_data = current_exact_path_data_velocity(path, P, sys)
+
+	def current_exact_path_velocity(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+		return current_exact_kernel(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data)
+
+	return current_exact_path_velocity
+
+
+def current_exact_path_data_velocity(path, P, sys):
+	"""
+	Path dependent input of the kernel from make_current_exact_kernel_velocity,
+	the k-points of the path before the shift by the vector potential.
+	"""
+	return path[:, 0], path[:, 1]
+
+
+def make_current_exact_kernel_velocity(P, sys):
+	"""
+	Path independent kernel of make_current_exact_path_velocity. The path enters
+	as path_data from current_exact_path_data_velocity, such that one compiled
+	kernel serves all paths (e.g. inside the compiled time loop).
+	"""
 	E_dir = P.E_dir
 
 	hderivx = sys.hderivfjit[0]
@@ -255,15 +279,11 @@ def make_current_exact_path_velocity(path, P, sys):
 
 	E_ort = np.array([E_dir[1], -E_dir[0]])
 
-	kx_in_path_before_shift = path[:, 0]
-	ky_in_path_before_shift = path[:, 1]
-	pathlen = kx_in_path_before_shift.size
-
 	type_complex_np = P.type_complex_np
 	symmetric_insulator = P.symmetric_insulator
 	dm_dynamics_method = P.dm_dynamics_method
-	@conditional_njit(type_complex_np)
-	def current_exact_path_velocity(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+	@conditional_njit(type_complex_np, parallel=P.num_threads > 1)
+	def current_exact_kernel_velocity(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data):
 		'''
 		Calculates current from the system density matrix
 
@@ -275,6 +295,8 @@ def make_current_exact_path_velocity(path, P, sys):
 		    Per timestep E_field
 		A_field : type_real_np
 		    In the velocity gauge this determines the k-shift
+		path_data : tuple
+		    kx and ky components of the path before the shift
 
 		Returns:
 		--------
@@ -283,6 +305,9 @@ def make_current_exact_path_velocity(path, P, sys):
 		I_ortho : type_real_np
 		    Orthogonal to electric field component of current
 		'''
+		kx_in_path_before_shift, ky_in_path_before_shift = path_data
+		pathlen = kx_in_path_before_shift.size
+
 		solution = solution.reshape(pathlen, 4)
 		##########################################################
 		# H derivative container
@@ -345,7 +370,7 @@ def make_current_exact_path_velocity(path, P, sys):
 		if symmetric_insulator:
 			rho_vv = -rho_cc + 1
 
-		for i_k in range(pathlen):
+		for i_k in prange(pathlen):
 
 			dH_U_E_dir = h_deriv_E_dir[i_k] @ U[i_k]
 			U_h_H_U_E_dir = U_h[i_k] @ dH_U_E_dir
@@ -368,7 +393,7 @@ def make_current_exact_path_velocity(path, P, sys):
 
 		return I_E_dir, I_ortho
 
-	return current_exact_path_velocity
+	return current_exact_kernel_velocity
 
 
 def make_current_exact_path_length(path, P, sys):
@@ -394,6 +419,20 @@ def make_current_exact_path_length(path, P, sys):
 	current_kernel : function
 	    Calculates per timestep current of a path
 	"""
+	current_exact_kernel = make_current_exact_kernel_length(P, sys)
+	path_data = current_exact_path_data_length(path, P, sys)
+
+	def current_exact_path_length(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+		return current_exact_kernel(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data)
+
+	return current_exact_path_length
+
+
+def current_exact_path_data_length(path, P, sys):
+	"""
+	Path dependent input of the kernel from make_current_exact_kernel_length:
+	derivatives of the Hamiltonian, wave functions and Berry curvature on the path.
+	"""
 	E_dir = P.E_dir
 	E_ort = P.E_ort
 
@@ -407,10 +446,10 @@ def make_current_exact_path_length(path, P, sys):
 	if P.dm_dynamics_method == 'semiclassics':
 		Bcurv = np.empty((pathlen, 2), dtype=P.type_complex_np)
 
-	h_deriv_x = evaluate_njit_matrix(sys.hderivfjit[0], kx=kx_in_path, ky=ky_in_path,
-	                                 dtype=P.type_complex_np)
-	h_deriv_y = evaluate_njit_matrix(sys.hderivfjit[1], kx=kx_in_path, ky=ky_in_path,
-	                                 dtype=P.type_complex_np)
+	h_fused = np.empty((3, pathlen, P.n, P.n), dtype=P.type_complex_np)
+	sys.hfusedjit(h_fused, kx=kx_in_path, ky=ky_in_path)
+	h_deriv_x = h_fused[1]
+	h_deriv_y = h_fused[2]
 
 	h_deriv_E_dir= h_deriv_x*E_dir[0] + h_deriv_y*E_dir[1]
 	h_deriv_ortho = h_deriv_x*E_ort[0] + h_deriv_y*E_ort[1]
@@ -421,11 +460,23 @@ def make_current_exact_path_length(path, P, sys):
 	if P.dm_dynamics_method == 'semiclassics':
 		Bcurv[:, 0] = sys.Bfjit[0][0](kx=kx_in_path, ky=ky_in_path)
 		Bcurv[:, 1] = sys.Bfjit[1][1](kx=kx_in_path, ky=ky_in_path)
+	else:
+		# Only read in semiclassics, path_data stays a tuple of arrays
+		Bcurv = np.zeros((0, 2), dtype=P.type_complex_np)
+
+	return h_deriv_E_dir, h_deriv_ortho, U, U_h, Bcurv
+
 
+def make_current_exact_kernel_length(P, sys):
+	"""
+	Path independent kernel of make_current_exact_path_length. The path enters
+	as path_data from current_exact_path_data_length, such that one compiled
+	kernel serves all paths (e.g. inside the compiled time loop).
+	"""
 	symmetric_insulator = P.symmetric_insulator
 	dm_dynamics_method = P.dm_dynamics_method
-	@conditional_njit(P.type_complex_np)
-	def current_exact_path_length(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+	@conditional_njit(P.type_complex_np, parallel=P.num_threads > 1)
+	def current_exact_kernel_length(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data):
 		'''
 		Parameters:
 		-----------
@@ -435,8 +486,8 @@ def make_current_exact_path_length(path, P, sys):
 		    Per timestep E_field
 		_A_field : dummy
 		    In the length gauge this is just a dummy variable
-		j_k_E_dir_path
-
+		path_data : tuple
+		    h_deriv_E_dir, h_deriv_ortho, U, U_h and Bcurv of the path
 
 		Returns:
 		--------
@@ -445,6 +496,9 @@ def make_current_exact_path_length(path, P, sys):
 		I_ortho : type_real_np
 		    Orthogonal to electric field component of current
 		'''
+		h_deriv_E_dir, h_deriv_ortho, U, U_h, Bcurv = path_data
+		pathlen = U.shape[0]
+
 		solution = solution.reshape(pathlen, 4)
 		I_E_dir = 0
 		I_ortho = 0
@@ -457,7 +511,7 @@ def make_current_exact_path_length(path, P, sys):
 		if symmetric_insulator:
 			rho_vv = -rho_cc
 
-		for i_k in range(pathlen):
+		for i_k in prange(pathlen):
 			U_h_H_U_E_dir = U_h[i_k] @ (h_deriv_E_dir[i_k] @ U[i_k])
 			U_h_H_U_ortho = U_h[i_k] @ (h_deriv_ortho[i_k] @ U[i_k])
 
@@ -476,15 +530,63 @@ def make_current_exact_path_length(path, P, sys):
 
 		return I_E_dir, I_ortho
 
-	return current_exact_path_length
+	return current_exact_kernel_length
+
+def make_current_exact_batch(current_exact_kernel, P):
+	"""
+	Exact current of several paths in one call, used with batch_paths.
+
+	Parameters
+	----------
+	current_exact_kernel : jitted function
+	    Path independent kernel, e.g. from make_current_exact_kernel_length
+	P : class
+	    Default parameters combined with user parameters from the params.py file
+
+	Returns
+	-------
+	current_exact_batch : function
+	    Takes the density matrices of the paths stacked along the first axis and a
+	    tuple with the path_data of every path, returns the currents summed over the paths
+	"""
+	@conditional_njit(P.type_complex_np)
+	def current_exact_batch(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data):
+
+		# The first path fixes the type of the currents (scalars or sheet matrices)
+		J_E_dir, J_ortho = current_exact_kernel(solution[0], E_field_in_path, E_field_ortho,
+		                                        A_field_in_path, A_field_ortho, path_data[0])
+		for p in range(1, solution.shape[0]):
+			j_E_dir_buf, j_ortho_buf = current_exact_kernel(solution[p], E_field_in_path, E_field_ortho,
+			                                                A_field_in_path, A_field_ortho, path_data[p])
+			J_E_dir += j_E_dir_buf
+			J_ortho += j_ortho_buf
+
+		return J_E_dir, J_ortho
+
+	return current_exact_batch
 
 ##########################################################################################
 ### Observables from given bandstructures
 ##########################################################################################
 def make_current_exact_bandstructure_velocity(path, P, sys):
 
-	Nk1 = P.Nk1
-	n = P.n
+	current_exact_kernel = make_current_exact_kernel_bandstructure_velocity(P, sys)
+	path_data = current_exact_path_data_bandstructure_velocity(path, P, sys)
+
+	def current_exact_path(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+		return current_exact_kernel(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data)
+
+	return current_exact_path
+
+def current_exact_path_data_bandstructure_velocity(path, P, sys):
+	"""
+	Path dependent input of make_current_exact_kernel_bandstructure_velocity,
+	the k-points of the path before the shift by the vector potential.
+	"""
+	return path[:, 0], path[:, 1]
+
+def make_current_exact_kernel_bandstructure_velocity(P, sys):
+
 	E_dir = P.E_dir
 	E_ort = np.array([E_dir[1], -E_dir[0]])
 
@@ -499,10 +601,6 @@ def make_current_exact_bandstructure_velocity(path, P, sys):
 	mel10y = sys.melyjit[1][0]
 	mel11y = sys.melyjit[1][1]
 
-	kx_in_path_before_shift = path[:, 0]
-	ky_in_path_before_shift = path[:, 1]
-	pathlen = kx_in_path_before_shift.size
-
 	type_complex_np = P.type_complex_np
 
 	# mel_x = evaluate_njit_matrix(sys.melxjit, kx=kx_in_path, ky=ky_in_path, dtype=P.type_complex_np)
@@ -511,8 +609,11 @@ def make_current_exact_bandstructure_velocity(path, P, sys):
 	# mel_in_path = P.E_dir[0]*mel_x + P.E_dir[1]*mel_y
 	# mel_ortho = P.E_ort[0]*mel_x + P.E_ort[1]*mel_y
 
-	@conditional_njit(P.type_complex_np)
-	def current_exact_path(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+	@conditional_njit(P.type_complex_np, parallel=P.num_threads > 1)
+	def current_exact_kernel(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data):
+
+		kx_in_path_before_shift, ky_in_path_before_shift = path_data
+		pathlen = kx_in_path_before_shift.size
 
 		kx_in_path = kx_in_path_before_shift + A_field_in_path*E_dir[0]
 		ky_in_path = ky_in_path_before_shift + A_field_in_path*E_dir[1]
@@ -541,7 +642,7 @@ def make_current_exact_bandstructure_velocity(path, P, sys):
 		rho_cv = solution[:, 1, 0]
 		rho_cc = solution[:, 1, 1]
 
-		for i_k in range(pathlen):
+		for i_k in prange(pathlen):
 			J_exact_E_dir += - mel_in_path[i_k, 0, 0].real * (rho_vv[i_k].real - 1)
 			J_exact_E_dir += - mel_in_path[i_k, 1, 1].real * rho_cc[i_k].real
 			J_exact_E_dir += - 2*np.real( mel_in_path[i_k, 0, 1] * rho_cv[i_k] )
@@ -550,13 +651,23 @@ def make_current_exact_bandstructure_velocity(path, P, sys):
 			J_exact_ortho += - mel_ortho[i_k, 1, 1].real * rho_cc[i_k].real
 			J_exact_ortho += - 2*np.real( mel_ortho[i_k, 0, 1] * rho_cv[i_k] )
 		return J_exact_E_dir, J_exact_ortho
-	return current_exact_path
+	return current_exact_kernel
 
 def make_current_exact_bandstructure(path, P, sys):
 
-	Nk1 = P.Nk1
-	n = P.n
+	current_exact_kernel = make_current_exact_kernel_bandstructure(P, sys)
+	path_data = current_exact_path_data_bandstructure(path, P, sys)
+
+	def current_exact_path(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+		return current_exact_kernel(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data)
 
+	return current_exact_path
+
+def current_exact_path_data_bandstructure(path, P, sys):
+	"""
+	Path dependent input of make_current_exact_kernel_bandstructure,
+	the matrix elements in and orthogonal to the field direction.
+	"""
 	kx_in_path = path[:, 0]
 	ky_in_path = path[:, 1]
 
@@ -564,15 +675,24 @@ def make_current_exact_bandstructure(path, P, sys):
 	mel_y = evaluate_njit_matrix(sys.melyjit, kx=kx_in_path, ky=ky_in_path, dtype=P.type_complex_np)
 
 	mel_in_path = P.E_dir[0]*mel_x + P.E_dir[1]*mel_y
-	mel_ortho = P.E_ort[0]*mel_x + P.E_ort[1]*mel_y	
+	mel_ortho = P.E_ort[0]*mel_x + P.E_ort[1]*mel_y
 
-	@conditional_njit(P.type_complex_np)
-	def current_exact_path(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+	return mel_in_path, mel_ortho
+
+def make_current_exact_kernel_bandstructure(P, sys):
+
+	Nk1 = P.Nk1
+	n = P.n
+
+	@conditional_njit(P.type_complex_np, parallel=P.num_threads > 1)
+	def current_exact_kernel(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data):
+
+		mel_in_path, mel_ortho = path_data
 
 		J_exact_E_dir = 0
 		J_exact_ortho = 0
 
-		for i_k in range(Nk1):
+		for i_k in prange(Nk1):
 			for i in range(n):
 				J_exact_E_dir -=  mel_in_path[i_k, i, i].real * solution[i_k, i, i].real
 				J_exact_ortho -=  mel_ortho[i_k, i, i].real * solution[i_k, i, i].real
@@ -583,7 +703,7 @@ def make_current_exact_bandstructure(path, P, sys):
 
 		return J_exact_E_dir, J_exact_ortho
 
-	return current_exact_path
+	return current_exact_kernel
 
 def make_intraband_current_bandstructure_velocity(path, P, sys):
 	"""
@@ -791,24 +911,36 @@ def make_current_exact_path_hderiv_length(path, P, sys):
 		Function that calculates the exact current via eq. (79)
 	"""
 
+	current_exact_kernel = make_current_exact_kernel_hderiv_length(P, sys)
+	path_data = current_exact_path_data_hderiv_length(path, P, sys)
+
+	def current_exact_path_hderiv_length(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+		return current_exact_kernel(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data)
+
+	return current_exact_path_hderiv_length
+
+def current_exact_path_data_hderiv_length(path, P, sys):
+
+	"""
+		Path dependent input of make_current_exact_kernel_hderiv_length: matrix elements,
+		wave functions and Berry curvature of the path
+	"""
+
 	E_dir = P.E_dir
 	E_ort = P.E_ort
 
 	Nk1 = P.Nk1
 	n = P.n
-	n_sheets = P.n_sheets
 	type_complex_np = P.type_complex_np
-	type_real_np = P.type_real_np
-	sheet_current= P.sheet_current
-	dm_dynamics_method = P.dm_dynamics_method
 	wf_in_path = sys.wf_in_path
-	Bcurv_path = sys.Bcurv_path
 
 	kx = path[:, 0]
 	ky = path[:, 1]
 
-	dhdkx = evaluate_njit_matrix(sys.hderivfjit[0], kx=kx, ky=ky, dtype=type_complex_np)
-	dhdky = evaluate_njit_matrix(sys.hderivfjit[1], kx=kx, ky=ky, dtype=type_complex_np)
+	h_fused = np.empty((3, kx.size, n, n), dtype=type_complex_np)
+	sys.hfusedjit(h_fused, kx=kx, ky=ky)
+	dhdkx = h_fused[1]
+	dhdky = h_fused[2]
 
 	matrix_element_x = np.zeros([Nk1, n, n], dtype=type_complex_np)
 	matrix_element_y = np.zeros([Nk1, n, n], dtype=type_complex_np)
@@ -834,9 +966,27 @@ def make_current_exact_path_hderiv_length(path, P, sys):
 	mel_in_path = matrix_element_x * E_dir[0] + matrix_element_y * E_dir[1]
 	mel_ortho = matrix_element_x * E_ort[0] + matrix_element_y * E_ort[1]
 
+	return mel_in_path, mel_ortho, wf_in_path, sys.Bcurv_path
 
-	@conditional_njit(type_complex_np)
-	def current_exact_path_hderiv_length(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
+def make_current_exact_kernel_hderiv_length(P, sys):
+
+	"""
+		Path independent kernel of make_current_exact_path_hderiv_length, one compiled
+		kernel serves all paths (e.g. inside the compiled time loop)
+	"""
+
+	Nk1 = P.Nk1
+	n = P.n
+	n_sheets = P.n_sheets
+	type_complex_np = P.type_complex_np
+	type_real_np = P.type_real_np
+	sheet_current= P.sheet_current
+	dm_dynamics_method = P.dm_dynamics_method
+
+	@conditional_njit(type_complex_np, parallel=P.num_threads > 1)
+	def current_exact_kernel_hderiv_length(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho, path_data):
+
+		mel_in_path, mel_ortho, wf_in_path, Bcurv_path = path_data
 
 		if sheet_current:
 
@@ -862,7 +1012,7 @@ def make_current_exact_path_hderiv_length(path, P, sys):
 			J_exact_E_dir = 0
 			J_exact_ortho = 0
 
-			for i_k in range(Nk1):
+			for i_k in prange(Nk1):
 				for i in range(n):
 					J_exact_E_dir += - ( mel_in_path[i_k, i, i].real * solution[i_k, i, i].real )
 					J_exact_ortho += - ( mel_ortho[i_k, i, i].real * solution[i_k, i, i].real )
@@ -875,7 +1025,7 @@ def make_current_exact_path_hderiv_length(path, P, sys):
 						J_exact_ortho += - E_field_in_path * Bcurv_path[i_k, i].real * solution[i_k, i, i].real
 
 		return J_exact_E_dir, J_exact_ortho
-	return current_exact_path_hderiv_length
+	return current_exact_kernel_hderiv_length
 
 
 def make_polarization_inter_path_length(P, sys):
@@ -1004,81 +1154,75 @@ def make_current_exact_path_hderiv_velocity(path, P, sys):
 	ky_before_shift = path[:, 1]
 	pathlen = kx_before_shift.size
 
+	# Workspaces reused in every time step, all entries are overwritten in each call
+	h_fused = np.empty((3, pathlen, n, n), dtype=type_complex_np)
+	h_in_path = h_fused[0]
+	dhdkx = h_fused[1]
+	dhdky = h_fused[2]
+	if dm_dynamics_method == 'semiclassics':
+		hpex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp2ex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm2ex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp2ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm2ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp3ex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm3ex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp3ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm3ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp4ex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm4ex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp4ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm4ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp5ex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm5ex = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp5ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm5ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpexpey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpexp2ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpexp3ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpexp4ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpexmey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpexm2ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpexm3ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hpexm4ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmexpey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmexp2ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmexp3ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmexp4ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmexmey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmexm2ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmexm3ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hmexm4ey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp2expey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp3expey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp4expey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm2expey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm3expey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm4expey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp2exmey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp3exmey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hp4exmey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm2exmey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm3exmey = np.empty((pathlen, n, n), dtype=type_complex_np)
+		hm4exmey = np.empty((pathlen, n, n), dtype=type_complex_np)
 
 	def current_exact_path_hderiv_velocity(solution, E_field_in_path, E_field_ortho, A_field_in_path, A_field_ortho):
 
 		kx_in_path = kx_before_shift + A_field_in_path*E_dir[0]
 		ky_in_path = ky_before_shift + A_field_in_path*E_dir[1]
 
-		dhdkx = evaluate_njit_matrix(sys.hderivfjit[0], kx=kx_in_path, ky=ky_in_path, dtype=type_complex_np)
-		dhdky = evaluate_njit_matrix(sys.hderivfjit[1], kx=kx_in_path, ky=ky_in_path, dtype=type_complex_np)
+		# h, dh/dkx and dh/dky in one call
+		sys.hfusedjit(h_fused, kx=kx_in_path, ky=ky_in_path)
 
-		h_in_path = np.zeros((pathlen, n, n), dtype=type_complex_np)
 		if dm_dynamics_method == 'semiclassics':
-			hpex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp2ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm2ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp2ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm2ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp3ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm3ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp3ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm3ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp4ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm4ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp4ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm4ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp5ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm5ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp5ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm5ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpexpey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpexp2ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpexp3ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpexp4ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpexmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpexm2ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpexm3ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hpexm4ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmexpey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmexp2ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmexp3ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmexp4ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmexmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmexm2ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmexm3ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hmexm4ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp2expey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp3expey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp4expey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm2expey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm3expey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm4expey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp2exmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp3exmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hp4exmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm2exmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm3exmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-			hm4exmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-
-		for i in range(n):
-			for j in range(n):
-				for k in range(pathlen):
-					kx = kx_in_path[k]
-					ky = ky_in_path[k]
-					h_in_path[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky)
-
-
-		for i in range(n):
-			for j in range(n):
-				for k in range(pathlen):
-					kx = kx_in_path[k]
-					ky = ky_in_path[k]
-					h_in_path[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky)
-					if dm_dynamics_method == 'semiclassics':
+			for i in range(n):
+				for j in range(n):
+					for k in range(pathlen):
+						kx = kx_in_path[k]
+						ky = ky_in_path[k]
 						hpex[k, i, j] = sys.hfjit[i][j](kx=kx+P.epsilon, ky=ky)
 						hmex[k, i, j] = sys.hfjit[i][j](kx=kx-P.epsilon, ky=ky)
 						hpey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+P.epsilon)
@@ -1,5 +1,7 @@
+import multiprocessing
 import os
 from cued.main import sbe_solver
+from cued.utility import ParamsParser
 
 
 def mkdir(dirname):
@@ -31,18 +33,67 @@ def chirp_phasesweep(chirplist, phaselist, system, params):
         os.chdir('..')
 
 
-def phasesweep_parallel(phaselist, system, params):
-    for phase in phaselist:
-        pid = os.fork()
-
-        if pid == 0:
-            params.phase = phase
-            print("Current phase: ", params.phase)
-            dirname_phase = 'phase_{:1.2f}'.format(params.phase)
-            mkdir_chdir(dirname_phase)
-            sbe_solver(system, params)
-
-            return 0
+def phasesweep_parallel(phaselist, system, params, processes=None):
+    """
+    Runs every phase of phaselist on a pool of at most processes workers (default: number
+    of CPUs) and returns the current dictionaries of cued.main.current_arrays in the
+    order of phaselist.
+    """
+    return sweep_parallel([{'phase': phase} for phase in phaselist], system, params, processes)
+
+
+def sweep_parallel(overrides_list, system, params, processes=None):
+    """
+    Runs sbe_solver once for every dictionary of parameter overrides in overrides_list,
+    e.g. [{'phase': 0.0, 'E0': 5.0}, ...], on a pool of at most processes persistent
+    workers (default: number of CPUs). params and the overrides have to describe a single
+    parameter combination. The workers convert and compile the kernels of the system
+    once and return the currents in memory instead of writing data files.
+    Returns the current dictionaries of cued.main.current_arrays in the order of
+    overrides_list; a failing run raises its exception here.
+    """
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes, initializer=_init_sweep_worker, initargs=(system, params)) as pool:
+        return pool.map(_run_sweep_task, overrides_list, chunksize=1)
+
+
+_sweep_worker = {}
+_missing = object()
+
+
+def _init_sweep_worker(system, params):
+    _sweep_worker['system'] = system
+    _sweep_worker['params'] = params
+    _sweep_worker['originals'] = {}
+
+
+def _run_sweep_task(overrides):
+    params = _sweep_worker['params']
+    originals = _sweep_worker['originals']
+
+    # Undo the overrides of the previous run of this worker
+    for key, value in originals.items():
+        if value is _missing:
+            delattr(params, key)
+        else:
+            setattr(params, key, value)
+    originals.clear()
+
+    for key, value in dict(overrides, save_output=False).items():
+        originals[key] = params.__dict__.get(key, _missing)
+        setattr(params, key, value)
+
+    print("Current parameters: ", overrides)
+    try:
+        # sbe_solver returns one dictionary per combination, a sweep point is a single one
+        number_of_combinations = ParamsParser(params).number_of_combinations
+        if number_of_combinations != 1:
+            raise ValueError('params and the overrides ' + str(overrides) + ' describe '
+                             + str(number_of_combinations) + ' parameter combinations instead of one')
+        return sbe_solver(_sweep_worker['system'], params, return_currents=True)[0]
+    except SystemExit as error:
+        # sys.exit in a pool worker would kill it without reporting back
+        raise RuntimeError('sbe_solver stopped for ' + str(overrides) + ': ' + str(error)) from None
 
 
 # def parallel_chirp_phasesweep(chirplist, phaselist, system, dipole, params):
@@ -1,7 +1,41 @@
-from .helpers import *
-from .read_data import *
-from .fourier_plots import *
-from .time_plots import *
-from .cep_plots import *
-from .latex_settings_units import *
-from .latex_output_pdf import *
+import importlib
+
+from .read_data import read_datasets, read_dataset
+
+# Names of the modules depending on matplotlib, tikzplotlib and LaTeX. The modules
+# are imported on first access of one of their names, such that runs without plots
+# never load them.
+__lazy_names = {
+	'helpers': ['default_labels', 'default_colors', 'label_inner', 'contourf_remove_white_lines'],
+	'fourier_plots': ['fourier_total', 'fourier_dir_ortho', 'fourier_ana_num', 'fourier_dir_ortho_split',
+	                  'fourier_dir_ortho_angle', 'fourier_dir_ortho_angle_polar'],
+	'time_plots': ['time_grid', 'time_dir_ortho_angle', 'time_dir_ortho'],
+	'cep_plots': ['cep_plot'],
+	'latex_settings_units': ['symb', 'unit', 'parse_cued_aliases', 'init_matplotlib_config'],
+	'latex_output_pdf': ['conditional_pdflatex', 'write_and_compile_latex_PDF', 'write_parameters', 'tikz_time',
+	                     'tikz_freq', 'replace', 'get_time_indices_for_plotting', 'get_indices_for_plotting_whole',
+	                     'get_freq_indices_for_plotting', 'get_symmetry_path_in_BZ', 'BZ_plot',
+	                     'bandstruc_and_dipole_plot_high_symm_line', 'plot_it', 'dipole_quiver_plots',
+	                     'plot_single_dipole', 'density_matrix_plot', 'plot_dm_for_all_t',
+	                     'tikz_screening_one_color', 'tikz_screening_per_color',
+	                     'write_and_compile_screening_latex_PDF'],
+}
+__lazy_modules = {name: module_name for module_name, names in __lazy_names.items() for name in names}
+__submodules = ['animation', 'colormap'] + list(__lazy_names)
+
+__all__ = ['read_datasets', 'read_dataset'] + list(__lazy_modules)
+
+
+def __getattr__(name):
+	if name in __lazy_modules:
+		value = getattr(importlib.import_module('.' + __lazy_modules[name], __name__), name)
+	elif name in __submodules:
+		value = importlib.import_module('.' + name, __name__)
+	else:
+		raise AttributeError("module " + __name__ + " has no attribute " + name)
+	globals()[name] = value
+	return value
+
+
+def __dir__():
+	return sorted(set(globals()) | set(__all__) | set(__submodules))
@@ -1,6 +1,7 @@
 import numpy as np
 import numpy.linalg as lin
-from cued.utility import conditional_njit, evaluate_njit_matrix
+from numba import objmode, prange
+from cued.utility import conditional_njit, evaluate_njit_matrix, spectral_k_derivative
 
 
 def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
@@ -37,7 +38,9 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
     gamma1 = P.gamma1
     gamma2 = P.gamma2
     type_complex_np = P.type_complex_np
-    dk_order = P.dk_order
+    # The spectral k-derivative skips all finite-difference stencils (dk_order 0)
+    spectral = P.dk_order == 'spectral'
+    dk_order = 0 if spectral else P.dk_order
     dm_dynamics_method = P.dm_dynamics_method
     E_dir = P.E_dir
     E_ort = P.E_ort
@@ -46,6 +49,10 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
     Nk2 = P.Nk2
     split_paths = P.split_paths
     split_order = P.split_order
+    fock_fft = P.fock_exchange == 'fft'
+    # Loops over k run on P.num_threads numba threads. With batch_paths the threads
+    # take whole paths in fbatch instead, numba can not nest the parallel regions
+    parallel = P.num_threads > 1 and not P.batch_paths
 
     if sys.system == 'ana':
 
@@ -73,14 +80,15 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
         # Coulomb-interaction matrix
         v_k_kprime = sys.v_k_kprime
 
-    @conditional_njit(P.type_complex_np)
-    def flength(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+    @conditional_njit(P.type_complex_np, parallel=parallel)
+    def flength(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
         """
         Length gauge doesn't need recalculation of energies and dipoles.
         The length gauge is evaluated on a constant pre-defined k-grid.
         """
-        # x != y(t+dt)
-        x = np.empty(np.shape(y), dtype=type_complex_np)
+        # x != y(t+dt), written to the preallocated x if given
+        if x is None:
+            x = np.empty(np.shape(y), dtype=type_complex_np)
 
         # Gradient term coefficient
         electric_f_in_path = electric_field_in_path(t)
@@ -89,7 +97,12 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
 
         # Update the solution vector
         Nk_path = kpath.shape[0]
-        for k in range(Nk_path):
+
+        if spectral:
+            with objmode(dydk='complex128[:]'):
+                dydk = spectral_k_derivative(y[:-2].reshape(Nk_path, 4)).ravel()
+
+        for k in prange(Nk_path):
             i = 4*k
             right4 = 4*(k+4)
             right3 = 4*(k+3)
@@ -173,28 +186,43 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
                              + y[left4+1] /280 - 4/105*y[left3+1]  + 1/5*y[left2+1]  - 4/5*y[left+1] )
                 x[i+3] += D*(- y[right4+3]/280 + 4/105*y[right3+3] - 1/5*y[right2+3] + 4/5*y[right+3] \
                              + y[left4+3] /280 - 4/105*y[left3+3]  + 1/5*y[left2+3]  - 4/5*y[left+3] )
+            elif spectral:
+                x[i]   += D*dydk[i]
+                x[i+1] += D*dydk[i+1]
+                x[i+3] += D*dydk[i+3]
 
             # additional fock terms
             if do_fock:
-                for kprime_y_idx in range(Nk2):
-                    for kprime_x_idx in range(Nk_path):
+                if fock_fft:
+                    # rho holds the exchange sums of make_fock_exchange_fft
+                    v_rho_diag = rho[k, Nk2_idx, 0, 0]
+                    v_rho_01 = rho[k, Nk2_idx, 0, 1]
 
-                        kx_idx_old = k
-                        kprime_x_idx_old = kprime_x_idx
-                        ky_idx_old = Nk2_idx
-                        kprime_y_idx_old = kprime_y_idx
+                    x[i]   += 2 * ( y[i+2] * v_rho_01 ).imag
 
-                        dist_kx_idx = int(np.abs(kx_idx_old - kprime_x_idx_old))
-                        dist_ky_idx = int(np.abs(ky_idx_old - kprime_y_idx_old))
+                    x[i+1] += 1j * ( y[i+1] * v_rho_diag - ( y[i] -1 - y[i+3] ) * v_rho_01 )
 
-                        if dist_kx_idx != 0 or dist_ky_idx != 0:
+                    x[i+3] += - 2 * ( y[i+2] * v_rho_01 ).imag
+                else:
+                    for kprime_y_idx in range(Nk2):
+                        for kprime_x_idx in range(Nk_path):
 
-                            x[i]   += 2 * v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+2] * rho[kprime_x_idx, kprime_y_idx, 0, 1] ).imag
+                            kx_idx_old = k
+                            kprime_x_idx_old = kprime_x_idx
+                            ky_idx_old = Nk2_idx
+                            kprime_y_idx_old = kprime_y_idx
 
-                            x[i+1] += 1j*v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+1] * (rho[kprime_x_idx, kprime_y_idx, 0, 0] - 1 - rho[kprime_x_idx, kprime_y_idx, 1, 1] ) \
-                                                                    - ( y[i] -1 - y[i+3] ) * rho[kprime_x_idx, kprime_y_idx, 0, 1] )
+                            dist_kx_idx = int(np.abs(kx_idx_old - kprime_x_idx_old))
+                            dist_ky_idx = int(np.abs(ky_idx_old - kprime_y_idx_old))
 
-                            x[i+3] += - 2 * v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+2] * rho[kprime_x_idx, kprime_y_idx, 0, 1] ).imag
+                            if dist_kx_idx != 0 or dist_ky_idx != 0:
+
+                                x[i]   += 2 * v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+2] * rho[kprime_x_idx, kprime_y_idx, 0, 1] ).imag
+
+                                x[i+1] += 1j*v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+1] * (rho[kprime_x_idx, kprime_y_idx, 0, 0] - 1 - rho[kprime_x_idx, kprime_y_idx, 1, 1] ) \
+                                                                        - ( y[i] -1 - y[i+3] ) * rho[kprime_x_idx, kprime_y_idx, 0, 1] )
+
+                                x[i+3] += - 2 * v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+2] * rho[kprime_x_idx, kprime_y_idx, 0, 1] ).imag
 
             x[i+2] = x[i+1].conjugate()
 
@@ -234,8 +262,8 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
 
         return ecv_in_path, dipole_in_path, dipole_ortho, A_in_path, A_ortho
 
-    @conditional_njit(P.type_complex_np)
-    def fvelocity(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+    @conditional_njit(P.type_complex_np, parallel=parallel)
+    def fvelocity(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
         """
         Velocity gauge needs a recalculation of energies and dipoles as k
         is shifted according to the vector potential A
@@ -243,8 +271,9 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
 
         ecv_in_path, dipole_in_path[:, 0, 1], dipole_ortho[:, 0, 1], A_in_path, A_ortho = pre_velocity(kpath, y[-2].real, y[-1].real)
  
-        # x != y(t+dt)
-        x = np.empty(np.shape(y), dtype=type_complex_np)
+        # x != y(t+dt), written to the preallocated x if given
+        if x is None:
+            x = np.empty(np.shape(y), dtype=type_complex_np)
 
         electric_f_in_path = electric_field_in_path(t)
         electric_f_ortho = electric_field_ortho(t)
@@ -252,7 +281,7 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
         # Update the solution vector
         Nk_path = kpath.shape[0]
         interaction_term = np.zeros((4*Nk_path))
-        for k in range(Nk_path):
+        for k in prange(Nk_path):
             i = 4*k
             # Energy term eband(i,k) the energy of band i at point k
             ecv = ecv_in_path[k]
@@ -281,34 +310,45 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
 
             # additional fock terms
             if do_fock:
-                for kprime_y_idx in range(Nk2):
-                    for kprime_x_idx in range(Nk_path):
-                        if split_paths:
-                            for o in range(split_order):
-                                if Nk2_idx % split_order == o:
-                                    kx_idx_old = k + o*Nk_path
-                                    ky_idx_old = int( (Nk2_idx - o) / split_order )
-                                if kprime_y_idx % split_order == o:
-                                    kprime_x_idx_old = kprime_x_idx + o*Nk_path
-                                    kprime_y_idx_old = int( (kprime_y_idx - o) / split_order )
+                if fock_fft:
+                    # rho holds the exchange sums of make_fock_exchange_fft
+                    v_rho_diag = rho[k, Nk2_idx, 0, 0]
+                    v_rho_01 = rho[k, Nk2_idx, 0, 1]
 
-                        else:
-                            kx_idx_old = k
-                            kprime_x_idx_old = kprime_x_idx
-                            ky_idx_old = Nk2_idx
-                            kprime_y_idx_old = kprime_y_idx
+                    x[i]   += 2 * ( y[i+2] * v_rho_01 ).imag
+
+                    x[i+1] += 1j * ( y[i+1] * v_rho_diag - ( y[i] -1 - y[i+3] ) * v_rho_01 )
 
-                        dist_kx_idx = int(np.abs(kx_idx_old - kprime_x_idx_old))
-                        dist_ky_idx = int(np.abs(ky_idx_old - kprime_y_idx_old))
+                    x[i+3] += - 2 * ( y[i+2] * v_rho_01 ).imag
+                else:
+                    for kprime_y_idx in range(Nk2):
+                        for kprime_x_idx in range(Nk_path):
+                            if split_paths:
+                                for o in range(split_order):
+                                    if Nk2_idx % split_order == o:
+                                        kx_idx_old = k + o*Nk_path
+                                        ky_idx_old = int( (Nk2_idx - o) / split_order )
+                                    if kprime_y_idx % split_order == o:
+                                        kprime_x_idx_old = kprime_x_idx + o*Nk_path
+                                        kprime_y_idx_old = int( (kprime_y_idx - o) / split_order )
 
-                        if dist_kx_idx != 0 or dist_ky_idx != 0:
+                            else:
+                                kx_idx_old = k
+                                kprime_x_idx_old = kprime_x_idx
+                                ky_idx_old = Nk2_idx
+                                kprime_y_idx_old = kprime_y_idx
 
-                            x[i]   += 2 * v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+2] * rho[kprime_x_idx, kprime_y_idx, 0, 1] ).imag
+                            dist_kx_idx = int(np.abs(kx_idx_old - kprime_x_idx_old))
+                            dist_ky_idx = int(np.abs(ky_idx_old - kprime_y_idx_old))
 
-                            x[i+1] += 1j*v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+1] * (rho[kprime_x_idx, kprime_y_idx, 0, 0] - 1 - rho[kprime_x_idx, kprime_y_idx, 1, 1] ) \
-                                                                    - ( y[i] -1 - y[i+3] ) * rho[kprime_x_idx, kprime_y_idx, 0, 1] )
+                            if dist_kx_idx != 0 or dist_ky_idx != 0:
 
-                            x[i+3] += - 2 * v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+2] * rho[kprime_x_idx, kprime_y_idx, 0, 1] ).imag
+                                x[i]   += 2 * v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+2] * rho[kprime_x_idx, kprime_y_idx, 0, 1] ).imag
+
+                                x[i+1] += 1j*v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+1] * (rho[kprime_x_idx, kprime_y_idx, 0, 0] - 1 - rho[kprime_x_idx, kprime_y_idx, 1, 1] ) \
+                                                                        - ( y[i] -1 - y[i+3] ) * rho[kprime_x_idx, kprime_y_idx, 0, 1] )
+
+                                x[i+3] += - 2 * v_k_kprime[dist_kx_idx, dist_ky_idx] * ( y[i+2] * rho[kprime_x_idx, kprime_y_idx, 0, 1] ).imag
 
             x[i+2] = x[i+1].conjugate()
 
@@ -326,10 +366,16 @@ def make_rhs_ode_2_band(sys, electric_field_in_path, electric_field_ortho, P):
     else:
         raise AttributeError("You have to either assign velocity or length gauge")
 
+    if P.batch_paths:
+        return make_rhs_ode_batch(freturn, P)
+
+    if P.jit_time_loop or P.solver_method == 'dopri5':
+        # The compiled time loop and the dopri5 stepper call the jitted rhs directly
+        return freturn
 
     # The python solver does not directly accept jitted functions so we wrap it
-    def f(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
-        return freturn(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+    def f(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
+        return freturn(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x)
 
     return f
 
@@ -363,11 +409,16 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
     gamma2 = P.gamma2
     type_complex_np = P.type_complex_np
     type_real_np = P.type_real_np
-    dk_order = P.dk_order
+    # The spectral k-derivative skips all finite-difference stencils (dk_order 0)
+    spectral = P.dk_order == 'spectral'
+    dk_order = 0 if spectral else P.dk_order
     gauge = P.gauge
     system = sys.system
     E_dir = P.E_dir
     n = P.n
+    # Loops over k run on P.num_threads numba threads. With batch_paths the threads
+    # take whole paths in fbatch instead, numba can not nest the parallel regions
+    parallel = P.num_threads > 1 and not P.batch_paths
     if system == 'ana' or system == 'num':
         for i in range(P.n):
             for j in range(P.n):
@@ -400,8 +451,8 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
     gidx = P.gidx
     dm_dynamics_method = P.dm_dynamics_method
 
-    @conditional_njit(type_complex_np)
-    def fvelocity_custom_bs(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+    @conditional_njit(type_complex_np, parallel=parallel)
+    def fvelocity_custom_bs(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
         """
         Velocity gauge needs a recalculation of energies and dipoles as k
         is shifted according to the vector potential A
@@ -409,15 +460,16 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
 
         ecv_in_path, dipole_in_path[:, 0, 1], A_in_path = pre_velocity_custom_bs(kpath, y[-2].real)
 
-        # x != y(t+dt)
-        x = np.empty(np.shape(y), dtype=type_complex_np)
+        # x != y(t+dt), written to the preallocated x if given
+        if x is None:
+            x = np.empty(np.shape(y), dtype=type_complex_np)
 
         electric_f_in_path = electric_field_in_path(t)
         electric_f_ortho = 0
 
         # Update the solution vector
         Nk_path = kpath.shape[0]
-        for k in range(Nk_path):
+        for k in prange(Nk_path):
             i = 4*k
             # Energy term eband(i,k) the energy of band i at point k
             ecv = ecv_in_path[k]
@@ -473,14 +525,17 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
 
         return ecv_in_path, dipole_in_path, A_in_path
 
-    @conditional_njit(type_complex_np)
-    def flength(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+    @conditional_njit(type_complex_np, parallel=parallel)
+    def flength(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
         """
             function that multiplies the block-structure of the matrices of the RHS
             of the SBE with the solution vector
         """
-        # x != y(t+dt)
-        x = np.zeros(np.shape(y), dtype=type_complex_np)
+        # x != y(t+dt), written to the preallocated x if given
+        if x is None:
+            x = np.zeros(np.shape(y), dtype=type_complex_np)
+        else:
+            x[:] = 0
         # Gradient term coefficient
         electric_f_in_path = electric_field_in_path(t)
         electric_f_ortho = 0
@@ -488,7 +543,12 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
         D = electric_f_in_path/dk
 
         Nk_path = kpath.shape[0]
-        for k in range(Nk_path):
+
+        if spectral:
+            with objmode(dydk='complex128[:]'):
+                dydk = spectral_k_derivative(y[:-2].reshape(Nk_path, n**2)).ravel()
+
+        for k in prange(Nk_path):
             right4 = (k+4)
             right3 = (k+3)
             right2 = (k+2)
@@ -546,6 +606,8 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
                                                       -  1/5*y[right2*(n**2) + i*n + j] + 4/5*y[right*(n**2) + i*n + j] \
                                                       + y[left4*(n**2) + i*n + j]/280 - 4/105*y[left3*(n**2) + i*n + j] \
                                                       + 1/5*y[left2*(n**2) + i*n + j] - 4/5*y[left*(n**2) + i*n + j] )
+                    elif spectral:
+                        x[k*(n**2) + i*n + j] += D * dydk[k*(n**2) + i*n + j]
 
                     if i == j:
                         x[k*(n**2) + i*n + j] += - gamma1 * (y[k*(n**2) + i*n + j] - y0[k*(n**2) + i*n + j])
@@ -653,21 +715,24 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
         dipole_in_path = E_dir[0]*dipole_path_x + E_dir[1]*dipole_path_y
         return e_in_path, dipole_in_path
 
-    @conditional_njit(type_complex_np)
+    @conditional_njit(type_complex_np, parallel=parallel)
     def make_x(t, y, kpath, dipole_in_path, e_in_path, y0, dk, h_in_path, \
-                hpex, hmex, hp2ex, hm2ex, hp3ex, hm3ex, hp4ex, hm4ex, hpey, hmey, hp2ey, hm2ey, hp3ey, hm3ey, hp4ey, hm4ey):
+                hpex, hmex, hp2ex, hm2ex, hp3ex, hm3ex, hp4ex, hm4ex, hpey, hmey, hp2ey, hm2ey, hp3ey, hm3ey, hp4ey, hm4ey, x=None):
 
         e_in_path, dipole_in_path = pre_velocity_nband(h_in_path, hpex, hmex, hp2ex, hm2ex, hp3ex, hm3ex, hp4ex, hm4ex, hpey, \
                                                         hmey, hp2ey, hm2ey, hp3ey, hm3ey, hp4ey, hm4ey)
 
-        # x != y(t+dt)
-        x = np.zeros(np.shape(y), dtype=type_complex_np)
+        # x != y(t+dt), written to the preallocated x if given
+        if x is None:
+            x = np.zeros(np.shape(y), dtype=type_complex_np)
+        else:
+            x[:] = 0
 
         electric_f_in_path = electric_field_in_path(t)
         electric_f_ortho = 0
 
         Nk_path = kpath.shape[0]
-        for k in range(Nk_path):
+        for k in prange(Nk_path):
 
             wr = dipole_in_path[k, :, :]*electric_f_in_path
 
@@ -691,8 +756,12 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
 
         return x
 
+    h_workspace = {}
+    # Shifted path of the Hamiltonians in h_workspace, RK stages at the same time share them
+    h_workspace_path = {}
+
     #@conditional_njit(type_complex_np)
-    def fvelocity(t, y, kpath, dipole_in_path,  dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+    def fvelocity(t, y, kpath, dipole_in_path,  dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
         """
             function that multiplies the block-structure of the matrices of the RHS
             of the SBE with the solution vector
@@ -704,49 +773,39 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
         path_after_shift[:, 1] = kpath[:, 1] + E_dir[1]* y[-2].real
 
         pathlen = kpath[:, 0].size
-        h_in_path = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hpex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hmex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hpey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hmey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hp2ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hm2ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hp2ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hm2ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hp3ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hm3ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hp3ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hm3ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hp4ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hm4ex = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hp4ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-        hm4ey = np.zeros((pathlen, n, n), dtype=type_complex_np)
-
-        for i in range(n):
-            for j in range(n):
-                for k in range(pathlen):
-                    kx = path_after_shift[k, 0]
-                    ky = path_after_shift[k, 1]
-                    h_in_path[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky)
-                    hpex[k, i, j] = sys.hfjit[i][j](kx=kx-P.epsilon, ky=ky)
-                    hmex[k, i, j] = sys.hfjit[i][j](kx=kx+P.epsilon, ky=ky)
-                    hpey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky-P.epsilon)
-                    hmey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+P.epsilon)
-                    hp2ex[k, i, j] = sys.hfjit[i][j](kx=kx-2*P.epsilon, ky=ky)
-                    hm2ex[k, i, j] = sys.hfjit[i][j](kx=kx+2*P.epsilon, ky=ky)
-                    hp2ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky-2*P.epsilon)
-                    hm2ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+2*P.epsilon)
-                    hp3ex[k, i, j] = sys.hfjit[i][j](kx=kx-3*P.epsilon, ky=ky)
-                    hm3ex[k, i, j] = sys.hfjit[i][j](kx=kx+3*P.epsilon, ky=ky)
-                    hp3ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky-3*P.epsilon)
-                    hm3ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+3*P.epsilon)
-                    hp4ex[k, i, j] = sys.hfjit[i][j](kx=kx-4*P.epsilon, ky=ky)
-                    hm4ex[k, i, j] = sys.hfjit[i][j](kx=kx+4*P.epsilon, ky=ky)
-                    hp4ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky-4*P.epsilon)
-                    hm4ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+4*P.epsilon)
+        # Hamiltonians at the shifted k-points, every entry is overwritten below
+        if pathlen not in h_workspace:
+            h_workspace[pathlen] = np.empty((17, pathlen, n, n), dtype=type_complex_np)
+        h_in_path, hpex, hmex, hpey, hmey, hp2ex, hm2ex, hp2ey, hm2ey, \
+            hp3ex, hm3ex, hp3ey, hm3ey, hp4ex, hm4ex, hp4ey, hm4ey = h_workspace[pathlen]
+
+        if not np.array_equal(h_workspace_path.get(pathlen), path_after_shift):
+            h_workspace_path[pathlen] = path_after_shift
+            for i in range(n):
+                for j in range(n):
+                    for k in range(pathlen):
+                        kx = path_after_shift[k, 0]
+                        ky = path_after_shift[k, 1]
+                        h_in_path[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky)
+                        hpex[k, i, j] = sys.hfjit[i][j](kx=kx-P.epsilon, ky=ky)
+                        hmex[k, i, j] = sys.hfjit[i][j](kx=kx+P.epsilon, ky=ky)
+                        hpey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky-P.epsilon)
+                        hmey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+P.epsilon)
+                        hp2ex[k, i, j] = sys.hfjit[i][j](kx=kx-2*P.epsilon, ky=ky)
+                        hm2ex[k, i, j] = sys.hfjit[i][j](kx=kx+2*P.epsilon, ky=ky)
+                        hp2ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky-2*P.epsilon)
+                        hm2ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+2*P.epsilon)
+                        hp3ex[k, i, j] = sys.hfjit[i][j](kx=kx-3*P.epsilon, ky=ky)
+                        hm3ex[k, i, j] = sys.hfjit[i][j](kx=kx+3*P.epsilon, ky=ky)
+                        hp3ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky-3*P.epsilon)
+                        hm3ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+3*P.epsilon)
+                        hp4ex[k, i, j] = sys.hfjit[i][j](kx=kx-4*P.epsilon, ky=ky)
+                        hm4ex[k, i, j] = sys.hfjit[i][j](kx=kx+4*P.epsilon, ky=ky)
+                        hp4ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky-4*P.epsilon)
+                        hm4ey[k, i, j] = sys.hfjit[i][j](kx=kx, ky=ky+4*P.epsilon)
 
         x = make_x(t, y, kpath, dipole_in_path, e_in_path, y0, dk, h_in_path, \
-            hpex, hmex, hp2ex, hm2ex, hp3ex, hm3ex, hp4ex, hm4ex, hpey, hmey, hp2ey, hm2ey, hp3ey, hm3ey, hp4ey, hm4ey)
+            hpex, hmex, hp2ex, hm2ex, hp3ex, hm3ex, hp4ex, hm4ex, hpey, hmey, hp2ey, hm2ey, hp3ey, hm3ey, hp4ey, hm4ey, x)
 
         return x
 
@@ -763,7 +822,660 @@ def make_rhs_ode_n_band(sys, electric_field_in_path, electric_field_ortho, P):
     else:
         raise AttributeError("You have to either assign velocity or length gauge")
 
-    def f(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
-        return freturn(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+    if P.batch_paths:
+        if freturn is fvelocity:
+            raise AttributeError("Batched path propagation needs a jitted rhs, which is not available "
+                                 + "for the n-band solver in velocity gauge")
+        return make_rhs_ode_batch(freturn, P)
+
+    if P.jit_time_loop or P.solver_method == 'dopri5':
+        if freturn is fvelocity:
+            raise AttributeError("The compiled time loop and dopri5 need a jitted rhs, which is not available "
+                                 + "for the n-band solver in velocity gauge")
+        return freturn
+
+    def f(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
+        return freturn(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x)
 
     return f
+
+def make_fock_exchange_fft(v_k_kprime, P):
+    """
+        Exchange sums of the Fock term of the 2-band solver for all k of the Brillouin zone,
+            sum_k' v(k - k') * (rho_00(k') - 1 - rho_11(k'))  and  sum_k' v(k - k') * rho_01(k'),
+        evaluated as 2D FFT convolutions instead of a loop over k' for every k. v_k_kprime
+        depends on the absolute index offsets, i.e. the grid is open in both directions,
+        so the density matrices are zero-padded to (2*Nk1 - 1, 2*Nk2 - 1) points and the
+        convolution does not wrap around.
+
+        Parameters:
+        -----------
+            v_k_kprime : np.ndarray
+                Coulomb interaction for the index offsets, zero for k = k'
+            P : class
+                Default parameters combined with user parameters from the params.py file
+
+        Returns:
+        --------
+            fock_exchange : function
+                maps the density matrices rho of all paths to an array of the same shape
+                with the two sums in [..., 0, 0] and [..., 0, 1]
+    """
+    n = P.n
+    Nk1 = P.Nk1
+    Nk2 = P.Nk2
+    N1, N2 = v_k_kprime.shape
+    # Split paths are pieces of the paths of the full grid v_k_kprime refers to
+    split_order = P.split_order if P.split_paths else 1
+
+    shape = (2*N1 - 1, 2*N2 - 1)
+    offset_1 = np.abs(np.fft.fftfreq(shape[0], 1/shape[0])).astype(int)
+    offset_2 = np.abs(np.fft.fftfreq(shape[1], 1/shape[1])).astype(int)
+    v_fft = np.fft.fft2(v_k_kprime[np.ix_(offset_1, offset_2)])
+
+    def convolve(f):
+        return np.fft.ifft2(v_fft*np.fft.fft2(f, s=shape))[:N1, :N2]
+
+    def fock_exchange(rho):
+        rho_grid = rho.reshape(Nk1, N2, split_order, n, n).transpose(2, 0, 1, 3, 4).reshape(N1, N2, n, n)
+
+        exchange = np.zeros((N1, N2, n, n), dtype=P.type_complex_np)
+        exchange[:, :, 0, 0] = convolve(rho_grid[:, :, 0, 0] - 1 - rho_grid[:, :, 1, 1])
+        exchange[:, :, 0, 1] = convolve(rho_grid[:, :, 0, 1])
+
+        return exchange.reshape(split_order, Nk1, N2, n, n).transpose(1, 2, 0, 3, 4).reshape(Nk1, Nk2, n, n)
+
+    return fock_exchange
+
+def make_jac_ode_length(electric_field_in_path, P):
+    """
+        Analytic Jacobian d f_i / d y_j of the length gauge right hand side
+        for the zvode integrators (bdf, adams). As in the finite-difference
+        Jacobian of zvode, derivatives are taken along the real axis of y_j.
+
+        Parameters:
+        -----------
+            electric_field_in_path : jitted function
+                absolute value of the instantaneous driving field E(t)
+            P : class
+                Default parameters combined with user parameters from the params.py file
+
+        Returns:
+        --------
+            jac : function that returns the Jacobian, either dense or for
+                  P.jacobian == 'banded' in the packed format of zvode,
+                  jac_packed[i-j+uband, j] = jac[i, j]. The banded Jacobian
+                  drops the periodic wrap-around of the k-derivative at the
+                  ends of the path.
+    """
+    gamma1 = P.gamma1
+    gamma2 = P.gamma2
+    type_complex_np = P.type_complex_np
+    n = P.n
+    banded = P.jacobian == 'banded'
+    lband, uband = jacobian_bandwidth(P)
+
+    # Coefficients of the central finite difference at k+1, k+2, ... (k-m: -stencil[m-1])
+    if P.dk_order == 2:
+        stencil = np.array([1/2])
+    elif P.dk_order == 4:
+        stencil = np.array([2/3, -1/12])
+    elif P.dk_order == 6:
+        stencil = np.array([3/4, -3/20, 1/60])
+    elif P.dk_order == 8:
+        stencil = np.array([4/5, -1/5, 4/105, -1/280])
+    elif P.dk_order == 'spectral':
+        # The spectral derivative is circulant, its coefficient at k-m is minus the one at k+m
+        unit = np.zeros(P.Nk1)
+        unit[0] = 1
+        stencil = -spectral_k_derivative(unit).real[1:(P.Nk1 + 1)//2]
+
+    @conditional_njit(type_complex_np)
+    def empty_jac(size):
+        if banded:
+            return np.zeros((lband + uband + 1, size), dtype=type_complex_np)
+        return np.zeros((size, size), dtype=type_complex_np)
+
+    @conditional_njit(type_complex_np)
+    def add_entry(jac, row, col, value):
+        if banded:
+            if row - col <= lband and col - row <= uband:
+                jac[row - col + uband, col] += value
+        else:
+            jac[row, col] += value
+
+    @conditional_njit(type_complex_np)
+    def jlength_2_band(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+        """
+        Jacobian of flength of the 2-band solver, where p_cv is the complex
+        conjugate of p_vc.
+        """
+        jac = empty_jac(y.size)
+
+        electric_f_in_path = electric_field_in_path(t)
+        D = electric_f_in_path/dk
+
+        Nk_path = kpath.shape[0]
+        for k in range(Nk_path):
+            i = 4*k
+
+            ecv = e_in_path[k, 1] - e_in_path[k, 0]
+            A_in_path = dipole_in_path[k, 0, 0] - dipole_in_path[k, 1, 1]
+            wr = dipole_in_path[k, 0, 1]*electric_f_in_path
+            wr_c = wr.conjugate()
+            wr_d_diag = A_in_path*electric_f_in_path
+
+            # i = f_v, i+1 = p_vc, i+2 = p_cv, i+3 = f_c
+            add_entry(jac, i, i, -gamma1)
+            add_entry(jac, i, i+1, 2*wr_c.imag)
+
+            d_pvc = 1j*ecv - gamma2 + 1j*wr_d_diag
+            add_entry(jac, i+1, i, -1j*wr)
+            add_entry(jac, i+1, i+1, d_pvc)
+            add_entry(jac, i+1, i+3, 1j*wr)
+
+            add_entry(jac, i+2, i, 1j*wr_c)
+            add_entry(jac, i+2, i+1, d_pvc.conjugate())
+            add_entry(jac, i+2, i+3, -1j*wr_c)
+
+            add_entry(jac, i+3, i+1, -2*wr_c.imag)
+            add_entry(jac, i+3, i+3, -gamma1)
+
+            # drift term via k-derivative
+            for m in range(1, stencil.size + 1):
+                right = 4*((k + m) % Nk_path)
+                left = 4*((k - m) % Nk_path)
+                c = D*stencil[m-1]
+                add_entry(jac, i, right, c)
+                add_entry(jac, i, left, -c)
+                add_entry(jac, i+1, right+1, c)
+                add_entry(jac, i+1, left+1, -c)
+                add_entry(jac, i+2, right+1, c)
+                add_entry(jac, i+2, left+1, -c)
+                add_entry(jac, i+3, right+3, c)
+                add_entry(jac, i+3, left+3, -c)
+
+        return jac
+
+    @conditional_njit(type_complex_np)
+    def jlength_n_band(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+        """
+        Jacobian of flength of the n-band solver
+        """
+        jac = empty_jac(y.size)
+
+        electric_f_in_path = electric_field_in_path(t)
+        D = electric_f_in_path/dk
+
+        Nk_path = kpath.shape[0]
+        for k in range(Nk_path):
+            wr = dipole_in_path[k, :, :]*electric_f_in_path
+
+            for i in range(n):
+                for j in range(n):
+                    row = k*(n**2) + i*n + j
+
+                    if i == j:
+                        add_entry(jac, row, row, -gamma1)
+                    else:
+                        add_entry(jac, row, row, -1j*(e_in_path[k, i] - e_in_path[k, j]) - gamma2)
+
+                    # drift term via k-derivative
+                    for m in range(1, stencil.size + 1):
+                        right = ((k + m) % Nk_path)*(n**2) + i*n + j
+                        left = ((k - m) % Nk_path)*(n**2) + i*n + j
+                        c = D*stencil[m-1]
+                        add_entry(jac, row, right, c)
+                        add_entry(jac, row, left, -c)
+
+                    for nbar in range(n):
+                        if i == j and nbar != i:
+                            add_entry(jac, row, k*(n**2) + i*n + nbar, 2*wr[nbar, i].imag)
+                        else:
+                            add_entry(jac, row, k*(n**2) + i*n + nbar, -1j*wr[nbar, j])
+                            add_entry(jac, row, k*(n**2) + nbar*n + j, 1j*wr[i, nbar])
+
+        return jac
+
+    if P.solver == '2band':
+        jreturn = jlength_2_band
+    else:
+        jreturn = jlength_n_band
+
+    def jac(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+        return jreturn(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+
+    return jac
+
+def bind_jac_params(jac, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+    """
+        Jacobian jac(t, y) of a single path. zvode passes no jac_params to a
+        banded Jacobian, so for P.jacobian == 'banded' the path dependent
+        arguments are bound here instead of with set_jac_params.
+    """
+    def jac_path(t, y):
+        return jac(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+
+    return jac_path
+
+def jacobian_bandwidth(P):
+    """
+        Lower and upper bandwidth of the length gauge Jacobian: the k-derivative
+        couples each (n x n) block of k to the blocks up to dk_order/2 points away,
+        the spectral derivative to all blocks of the path.
+    """
+    if P.dk_order == 'spectral':
+        band = P.n**2*P.Nk1 - 1
+    else:
+        band = P.n**2*(P.dk_order//2 + 1) - 1
+    return band, band
+
+def diagonal_linear_part(e_in_path, P):
+    """
+        Diagonal linear part L of the SBE of a path, acting on y - y0: the band
+        energy phase -1j*(e_i - e_j) and damping -gamma2 of the coherences and
+        the damping -gamma1 of the occupations. The two vector potential
+        entries at the end of the solution vector get L = 0.
+
+        Parameters:
+        -----------
+            e_in_path : np.ndarray
+                band energies along the path, shape (Nk1, n)
+            P : class
+                Default parameters combined with user parameters from the params.py file
+
+        Returns:
+        --------
+            L : np.ndarray
+                diagonal of the linear part, same layout as the solution vector
+    """
+    n = P.n
+    L = -1j*(e_in_path[:, :, np.newaxis] - e_in_path[:, np.newaxis, :]) - P.gamma2
+    L[:, np.arange(n), np.arange(n)] = -P.gamma1
+
+    return np.append(L.reshape(-1), [0, 0]).astype(P.type_complex_np)
+
+def etd_rk4_coefficients(L, dt, M=32):
+    """
+        Coefficients of the exponential time differencing Runge-Kutta 4 scheme
+        of Cox and Matthews for the diagonal linear part L. The phi-functions are
+        evaluated as contour means around L*dt (Kassam and Trefethen), which is
+        free of cancellation for L*dt -> 0.
+
+        Returns:
+        --------
+            exp_L_dt, exp_L_half_dt, Q, f1, f2, f3 : np.ndarray
+                same layout as L
+    """
+    r = np.exp(2j*np.pi*(np.arange(1, M+1) - 0.5)/M)
+    LR = dt*L[:, np.newaxis] + r[np.newaxis, :]
+
+    Q  = dt*np.mean((np.exp(LR/2) - 1)/LR, axis=1)
+    f1 = dt*np.mean((-4 - LR + np.exp(LR)*(4 - 3*LR + LR**2))/LR**3, axis=1)
+    f2 = dt*np.mean((2 + LR + np.exp(LR)*(-2 + LR))/LR**3, axis=1)
+    f3 = dt*np.mean((-4 - 3*LR - LR**2 + np.exp(LR)*(4 - LR))/LR**3, axis=1)
+
+    return np.exp(dt*L), np.exp(0.5*dt*L), Q, f1, f2, f3
+
+def imex_ars343_coefficients(L, dt):
+    """
+        Butcher tableaux of the third-order implicit-explicit Runge-Kutta scheme
+        ARS(3,4,3) of Ascher, Ruuth and Spiteri. The implicit part is an L-stable,
+        stiffly accurate SDIRK with diagonal gamma, so the implicit stage equations
+        (1 - gamma*dt*L)*U = r for the diagonal L are solved by a multiplication
+        with the precomputed inverse.
+
+        Returns:
+        --------
+            A_im, A_ex : np.ndarray
+                implicit and explicit stage coefficients, shape (4, 4)
+            b : np.ndarray
+                weights of both tableaux
+            c : np.ndarray
+                stage times in units of dt
+            inv_stage : np.ndarray
+                1/(1 - gamma*dt*L), same layout as L
+    """
+    gamma = 0.4358665215
+    b1 = -3/2*gamma**2 + 4*gamma - 1/4
+    b2 = 3/2*gamma**2 - 5*gamma + 5/4
+
+    A_im = np.array([[0, 0,           0,     0    ],
+                     [0, gamma,       0,     0    ],
+                     [0, (1-gamma)/2, gamma, 0    ],
+                     [0, b1,          b2,    gamma]])
+    A_ex = np.array([[0,            0,            0,            0],
+                     [gamma,        0,            0,            0],
+                     [0.3212788860, 0.3966543747, 0,            0],
+                     [-0.105858296, 0.5529291479, 0.5529291479, 0]])
+    b = np.array([0, b1, b2, gamma])
+    c = np.array([0, gamma, (1+gamma)/2, 1])
+
+    return A_im, A_ex, b, c, 1/(1 - gamma*dt*L)
+
+def make_rhs_ode_batch(freturn, P):
+    """
+        Right hand side advancing several paths in one call. The solution vectors
+        of the paths are stacked along the first axis, all other path-dependent
+        arguments (kpath, dipoles, energies, y0, Nk2_idx) are stacked accordingly.
+
+        Parameters:
+        -----------
+            freturn : jitted function
+                right hand side of a single path
+            P : class
+                Default parameters combined with user parameters from the params.py file
+
+        Returns:
+        --------
+            fbatch : function that is the right hand side of the ode for all paths
+    """
+    type_complex_np = P.type_complex_np
+
+    @conditional_njit(type_complex_np, parallel=P.num_threads > 1)
+    def fbatch(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
+
+        # Written to the preallocated x if given
+        if x is None:
+            x = np.empty(np.shape(y), dtype=type_complex_np)
+
+        # Paths are independent, the threads take whole paths
+        for p in prange(y.shape[0]):
+            freturn(t, y[p], kpath[p], dipole_in_path[p], dipole_ortho[p], e_in_path[p], y0[p], dk, rho, Nk2_idx[p], x[p])
+
+        return x
+
+    return fbatch
+
+def make_rhs_ode_halo(freturn, exchange_halos, P):
+    """
+        Right hand side for a path whose k1 points are distributed over the ranks
+        of a k1 communicator (split_k1). The local solution vector is extended by
+        halos of dk_order/2 k-points of the neighbouring segments, the rhs of the
+        extended segment is evaluated and only the local points are returned.
+
+        Parameters:
+        -----------
+            freturn : function
+                right hand side of a single path
+            exchange_halos : function
+                exchange_halos(send_left, send_right, recv_left, recv_right) sends the
+                first and last halo points of the segment and receives the halos
+            P : class
+                Default parameters combined with user parameters from the params.py file
+
+        Returns:
+        --------
+            fhalo : function that is the right hand side of the ode for the local segment
+    """
+    type_complex_np = P.type_complex_np
+    n2 = P.n**2
+    halo_points = P.dk_order//2
+    # Number of entries of the solution vector in one halo
+    halo = halo_points*n2
+    workspace = {}
+
+    def pad(a):
+        # Path data of the halo points only enters their rhs, which is discarded
+        return np.concatenate((a[-halo_points:], a, a[:halo_points]))
+
+    def fhalo(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, x=None):
+
+        # Extended path data is built once per path
+        args = (kpath, dipole_in_path, dipole_ortho, e_in_path, y0)
+        if 'args' not in workspace or any(a is not b for a, b in zip(workspace['args'], args)):
+            workspace['args'] = args
+            workspace['ext'] = (pad(kpath), pad(dipole_in_path), pad(dipole_ortho), pad(e_in_path),
+                                np.concatenate((pad(y0[:-2].reshape(kpath.shape[0], n2)).ravel(), y0[-2:])))
+            workspace['y'] = np.empty(y.size + 2*halo, dtype=type_complex_np)
+            workspace['x'] = np.empty(y.size + 2*halo, dtype=type_complex_np)
+        kpath_ext, dipole_in_path_ext, dipole_ortho_ext, e_in_path_ext, y0_ext = workspace['ext']
+        y_ext = workspace['y']
+        x_ext = workspace['x']
+
+        y_ext[halo:-halo-2] = y[:-2]
+        y_ext[-2:] = y[-2:]
+        exchange_halos(y[:halo], y[-halo-2:-2], y_ext[:halo], y_ext[-halo-2:-2])
+
+        freturn(t, y_ext, kpath_ext, dipole_in_path_ext, dipole_ortho_ext, e_in_path_ext, y0_ext, dk, rho, Nk2_idx, x_ext)
+
+        if x is None:
+            x = np.empty(np.shape(y), dtype=type_complex_np)
+        x[:-2] = x_ext[halo:-halo-2]
+        x[-2:] = x_ext[-2:]
+
+        return x
+
+    return fhalo
+
+def make_rk4_time_loop(rhs_ode, current_exact_kernel, electric_field_in_path, electric_field_ortho, P):
+    """
+        Compiled Runge-Kutta 4 time loop of a single path. The stages, the
+        bookkeeping of the fields and the evaluation and accumulation of the
+        currents all run inside one numba function, such that a path is
+        propagated with a single call from python.
+
+        Parameters:
+        -----------
+            rhs_ode : jitted function
+                right hand side of a single path
+            current_exact_kernel : jitted function
+                path independent current kernel, the path enters via path_data
+            electric_field_in_path, electric_field_ortho : jitted functions
+                driving field in path and orthogonal direction
+            P : class
+                Default parameters combined with user parameters from the params.py file
+
+        Returns:
+        --------
+            rk4_time_loop : function propagating the solution vector y from t0 to tf.
+                The path dependent input of the current kernel (path_data) is an
+                argument, such that the loop is compiled once for all paths.
+    """
+    Nt = P.Nt
+    dt = P.dt
+    t0 = P.t0
+    Nk1 = P.Nk1
+    n = P.n
+    save_pdf_densmat = P.save_latex_pdf or P.save_dm_t
+
+    @conditional_njit(P.type_complex_np)
+    def rk4_time_loop(path_data, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx, \
+                      is_first_Nk2_idx, t, A_field_in_path, A_field_ortho, E_field_in_path, E_field_ortho, \
+                      j_E_dir, j_ortho, t_pdf_densmat, pdf_densmat_path, t_pdf_densmat_stored):
+
+        for ti in range(Nt):
+            # Construct time and fields only in the first round
+            if is_first_Nk2_idx:
+                t[ti] = ti*dt + t0
+                A_field_in_path[ti] = y[-2].real
+                A_field_ortho[ti] = y[-1].real
+                E_field_in_path[ti] = electric_field_in_path(t[ti])
+                E_field_ortho[ti] = electric_field_ortho(t[ti])
+
+            # Do not use the last 2 elements (A_field_in_path and A_field_ortho)
+            solution = y[:-2].reshape(Nk1, n, n)
+
+            if save_pdf_densmat:
+                for count in range(t_pdf_densmat.size):
+                    if (t_pdf_densmat[count] > t[ti-1] and t_pdf_densmat[count] < t[ti]) or t_pdf_densmat[count] == t[ti]:
+                        pdf_densmat_path[:, count, :, :] = solution
+                        t_pdf_densmat_stored[count] = t[ti]
+
+            j_E_dir_buf, j_ortho_buf = current_exact_kernel(solution, E_field_in_path[ti], E_field_ortho[ti], \
+                                                            A_field_in_path[ti], A_field_ortho[ti], path_data)
+            j_E_dir[ti] += j_E_dir_buf
+            j_ortho[ti] += j_ortho_buf
+
+            k1 = rhs_ode(t[ti],          y,          kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            k2 = rhs_ode(t[ti] + 0.5*dt, y + 0.5*k1, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            k3 = rhs_ode(t[ti] + 0.5*dt, y + 0.5*k2, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            k4 = rhs_ode(t[ti] +     dt, y +     k3, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+
+            y = y + dt/6 * (k1 + 2*k2 + 2*k3 + k4)
+
+        return y
+
+    return rk4_time_loop
+
+class Dopri5Solver():
+    """
+    Adaptive Dormand-Prince 5(4) integrator with error control and dense output.
+    The interface follows scipy.integrate.ode (set_initial_value, set_f_params,
+    integrate, successful, t, y), such that the solution is still obtained on the
+    dt grid of the user while the internal steps are chosen by the error estimate.
+    All steps between two output times are taken inside one jitted call.
+    """
+    def __init__(self, rhs_ode, P):
+
+        self.rtol = P.rtol
+        self.atol = P.atol
+        # Without user input, resolve the carrier period of the driving field by 10 steps
+        self.max_step = P.max_step
+        if self.max_step is None:
+            self.max_step = 0.1/P.f
+        self.first_step = P.dt
+        self.dopri5_steps = make_dopri5_steps(rhs_ode, P)
+        self.status = 0
+
+    def set_initial_value(self, y, t=0.0):
+
+        self.y = np.copy(y)
+        self.t = t
+        # State after the last internal step
+        self.t_step = t
+        self.y_step = np.copy(y)
+        self.k1 = None
+        self.h = self.first_step
+        # Dense output of the last internal step
+        self.t_old = t
+        self.h_old = 0.0
+        self.rcont = None
+        self.status = 0
+
+        return self
+
+    def set_f_params(self, *args):
+
+        self.f_params = args
+
+        return self
+
+    def integrate(self, t):
+
+        if self.k1 is None:
+            self.k1 = np.empty_like(self.y_step)
+            self.rcont = np.zeros((5, self.y_step.size), dtype=self.y_step.dtype)
+
+        if t > self.t_step:
+            self.t_step, self.y_step, self.k1, self.h, self.t_old, self.h_old, self.status = \
+                self.dopri5_steps(self.t_step, self.y_step, self.k1, self.h, t, self.rtol, self.atol,
+                                  self.max_step, self.rcont, self.status, *self.f_params)
+
+        if self.h_old > 0:
+            self.y = dopri5_dense_output(self.rcont, (t - self.t_old)/self.h_old)
+        self.t = t
+
+        return self.y
+
+    def successful(self):
+
+        return self.status >= 0
+
+
+def make_dopri5_steps(rhs_ode, P):
+    """
+        Jitted stepping routine of the Dormand-Prince 5(4) method (Hairer, Norsett,
+        Wanner, Solving ODE I, sec. II.5), with the continuous extension of order 4.
+
+        Parameters:
+        -----------
+            rhs_ode : jitted function
+                right hand side of a single path
+            P : class
+                Default parameters combined with user parameters from the params.py file
+
+        Returns:
+        --------
+            dopri5_steps : function taking adaptive steps from t until t_out is covered.
+                Status is 1 after the first rhs evaluation and -1 if the step size underflows.
+    """
+    type_complex_np = P.type_complex_np
+
+    c2, c3, c4, c5 = 1/5, 3/10, 4/5, 8/9
+    a21 = 1/5
+    a31, a32 = 3/40, 9/40
+    a41, a42, a43 = 44/45, -56/15, 32/9
+    a51, a52, a53, a54 = 19372/6561, -25360/2187, 64448/6561, -212/729
+    a61, a62, a63, a64, a65 = 9017/3168, -355/33, 46732/5247, 49/176, -5103/18656
+    a71, a73, a74, a75, a76 = 35/384, 500/1113, 125/192, -2187/6784, 11/84
+    e1, e3, e4, e5, e6, e7 = 71/57600, -71/16695, 71/1920, -17253/339200, 22/525, -1/40
+    d1, d3, d4 = -12715105075/11282082432, 87487479700/32700410799, -10690763975/1880347072
+    d5, d6, d7 = 701980252875/199316789632, -1453857185/822651844, 69997945/29380423
+
+    @conditional_njit(type_complex_np)
+    def dopri5_steps(t, y, k1, h, t_out, rtol, atol, max_step, rcont, status, \
+                     kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx):
+
+        if status == 0:
+            k1[:] = rhs_ode(t, y, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            status = 1
+
+        t_old = t
+        h_old = 0.0
+
+        while t < t_out:
+            h = min(h, max_step)
+            if h < 1e-12*max(abs(t), 1.0):
+                return t, y, k1, h, t_old, h_old, -1
+
+            k2 = rhs_ode(t + c2*h, y + h*a21*k1, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            k3 = rhs_ode(t + c3*h, y + h*(a31*k1 + a32*k2), kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            k4 = rhs_ode(t + c4*h, y + h*(a41*k1 + a42*k2 + a43*k3), kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            k5 = rhs_ode(t + c5*h, y + h*(a51*k1 + a52*k2 + a53*k3 + a54*k4), \
+                         kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            k6 = rhs_ode(t + h, y + h*(a61*k1 + a62*k2 + a63*k3 + a64*k4 + a65*k5), \
+                         kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+            y_new = y + h*(a71*k1 + a73*k3 + a74*k4 + a75*k5 + a76*k6)
+            k7 = rhs_ode(t + h, y_new, kpath, dipole_in_path, dipole_ortho, e_in_path, y0, dk, rho, Nk2_idx)
+
+            # Error estimate from the embedded 4th order solution
+            err_vec = h*(e1*k1 + e3*k3 + e4*k4 + e5*k5 + e6*k6 + e7*k7)
+            scale = atol + rtol*np.maximum(np.abs(y), np.abs(y_new))
+            err = np.sqrt(np.mean((np.abs(err_vec)/scale)**2))
+
+            if err > 0:
+                fac = min(10.0, max(0.2, 0.9*err**(-0.2)))
+            else:
+                fac = 10.0
+
+            if err <= 1.0:
+                # Coefficients of the dense output of the accepted step
+                y_diff = y_new - y
+                bspl = h*k1 - y_diff
+                rcont[0] = y
+                rcont[1] = y_diff
+                rcont[2] = bspl
+                rcont[3] = y_diff - h*k7 - bspl
+                rcont[4] = h*(d1*k1 + d3*k3 + d4*k4 + d5*k5 + d6*k6 + d7*k7)
+
+                t_old = t
+                h_old = h
+                t = t + h
+                y = y_new
+                k1[:] = k7
+                h = h*fac
+            else:
+                h = h*min(1.0, fac)
+
+        return t, y, k1, h, t_old, h_old, status
+
+    return dopri5_steps
+
+
+def dopri5_dense_output(rcont, theta):
+    """
+    Continuous extension of the last Dormand-Prince step at t_old + theta*h.
+    """
+    theta1 = 1 - theta
+    return rcont[0] + theta*(rcont[1] + theta1*(rcont[2] + theta*(rcont[3] + theta1*rcont[4])))
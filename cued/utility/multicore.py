@@ -14,6 +14,7 @@ class MpiHelpers:
         self.rank = self.comm.Get_rank()
 
         self.subcomm = None
+        self.k1comm = None
 
     def get_local_idx(self, idxmax):
         # Check whether there are more ranks than indices to partition
@@ -27,6 +28,53 @@ class MpiHelpers:
 
         return local_idx_list
 
+    def get_dynamic_idx(self, costs):
+        '''
+        Dynamic alternative to get_local_idx: rank 0 only coordinates and hands out
+        the indices of costs, most expensive first, to the other ranks whenever they
+        ask for work. On the other ranks the generator yields the indices to compute.
+        '''
+        tag = 1
+        if self.rank == 0:
+            queue = list(np.argsort(costs, kind='stable')[::-1])
+            status = MPI.Status()
+            working_ranks = self.size - 1
+            while working_ranks > 0:
+                self.comm.recv(source=MPI.ANY_SOURCE, tag=tag, status=status)
+                if queue:
+                    idx = int(queue.pop(0))
+                else:
+                    idx = None
+                    working_ranks -= 1
+                self.comm.send(idx, dest=status.Get_source(), tag=tag)
+            return
+
+        while True:
+            self.comm.send(None, dest=0, tag=tag)
+            idx = self.comm.recv(source=0, tag=tag)
+            if idx is None:
+                return
+            yield idx
+
+    def plan_params_paths_grid(self, number_of_combinations, Nk2):
+        '''
+        Searches all (p_params, p_paths) grids with p_params*p_paths <= size and
+        p_paths <= Nk2. The grid with the smallest predicted makespan
+        ceil(number_of_combinations/p_params)*ceil(Nk2/p_paths), measured in
+        single path calculations, is returned. Ties favour more parameter sets,
+        as these need no communication between each other, and then fewer ranks.
+        Ranks outside of the grid stay idle.
+        '''
+        best = None
+        for p_paths in range(1, min(self.size, Nk2) + 1):
+            for p_params in range(1, min(self.size//p_paths, number_of_combinations) + 1):
+                makespan = -(-number_of_combinations//p_params)*(-(-Nk2//p_paths))
+                key = (makespan, -p_params, p_paths)
+                if best is None or key < best[0]:
+                    best = (key, p_params, p_paths)
+
+        return best[1], best[2]
+
     def listchop(self, idxlist):
         if(self.rank == 0):
             ptuple = self.__equipartition(idxlist.size)
@@ -57,6 +105,38 @@ class MpiHelpers:
 
         return summed_np_array
 
+    def reduce_in_place(self, np_array):
+        '''
+        Sums np_array of all processes of subcomm in place onto rank 0 of subcomm,
+        without barriers. The other processes keep their local array.
+        '''
+        if self.subcomm.Get_rank() == 0:
+            self.subcomm.Reduce(MPI.IN_PLACE, np_array, op=MPI.SUM, root=0)
+        else:
+            self.subcomm.Reduce(np_array, None, op=MPI.SUM, root=0)
+
+    def iallgather_paths(self, local_paths, gathered_paths, counts):
+        '''
+        Nonblocking gather of the local paths of all ranks into gathered_paths.
+        counts holds the number of elements of local_paths on every rank.
+        '''
+        displace = [sum(counts[:i]) for i in range(len(counts))]
+
+        return self.subcomm.Iallgatherv(local_paths, [gathered_paths, (counts, displace)])
+
+    def exchange_halos(self, send_left, send_right, recv_left, recv_right):
+        '''
+        Periodic halo exchange between the k1 segments of a path in k1comm.
+        send_left (send_right) holds the first (last) points of the local
+        segment, they become the right (left) halo of the left (right) neighbour.
+        '''
+        size = self.k1comm.Get_size()
+        rank = self.k1comm.Get_rank()
+        left = (rank - 1) % size
+        right = (rank + 1) % size
+
+        self.k1comm.Sendrecv(send_left, dest=left, recvbuf=recv_right, source=right)
+        self.k1comm.Sendrecv(send_right, dest=right, recvbuf=recv_left, source=left)
 
     def __equipartition(self, L):
         '''
@@ -1,4 +1,5 @@
 from math import modf
+import os
 import sys
 import numpy as np
 import itertools
@@ -19,6 +20,15 @@ class ParamsParser():
         self.parallelize_over_points = None
         self.split_paths = None
         self.split_order = 1
+        self.split_k1 = False                             # Distribute the k1 points of a path over ranks (length gauge)
+        self.k1_segments = 1
+        self.dynamic_scheduling = False                   # Hand out parameter combinations to free ranks
+        self.num_threads = 1                              # Numba threads per MPI rank for the k-loops
+        self.points_per_block = 1                         # k-points propagated as one system with parallelize_over_points
+        self.compile_once = False                         # Rank 0 fills the symbolic and kernel caches for all ranks
+        self.symbolic_cache = False                       # Load and store symbolic derivatives in CUED_SYMBOLIC_CACHE (pickles)
+        self.shard_index = int(os.environ.get('CUED_SHARD_INDEX', 0))  # Shard of the parameter combinations run by this job
+        self.num_shards = int(os.environ.get('CUED_NUM_SHARDS', 1))    # Number of independent jobs sharing the combinations
 
         # build dictionary of all parameters, exclude t_pdf_densmat, points_to_path and parameters of Gabor transformation
         excl_set = {'__weakref__', '__doc__', '__dict__', '__module__',"t_pdf_densmat","parallelize_over_points",'gabor_gaussian_center','gabor_window_width'}
@@ -29,6 +39,22 @@ class ParamsParser():
             self.parallelize_over_points = UP.parallelize_over_points
         if hasattr(UP, 'split_paths'):
             self.split_paths = UP.split_paths
+        if hasattr(UP, 'split_k1'):
+            self.split_k1 = UP.split_k1
+        if hasattr(UP, 'dynamic_scheduling'):
+            self.dynamic_scheduling = UP.dynamic_scheduling
+        if hasattr(UP, 'num_threads'):
+            self.num_threads = UP.num_threads
+        if hasattr(UP, 'points_per_block'):
+            self.points_per_block = UP.points_per_block
+        if hasattr(UP, 'compile_once'):
+            self.compile_once = UP.compile_once
+        if hasattr(UP, 'symbolic_cache'):
+            self.symbolic_cache = UP.symbolic_cache
+        if hasattr(UP, 'shard_index'):
+            self.shard_index = UP.shard_index
+        if hasattr(UP, 'num_shards'):
+            self.num_shards = UP.num_shards
         if hasattr(UP, 't_pdf_densmat'):
             self.t_pdf_densmat = np.array(UP.t_pdf_densmat)*CoFa.fs_to_au # Time points for printing density matrix
         if hasattr(UP,'gabor_gaussian_center'):
@@ -53,6 +79,13 @@ class ParamsParser():
         # Build list with all possible parameter combinations
         self.params_combinations = list(itertools.product(*self.params_lists))
 
+        # Every shard runs every num_shards-th combination, starting at shard_index
+        if not isinstance(self.num_shards, (int, np.integer)) or self.num_shards < 1:
+            sys.exit("num_shards needs to be a positive integer.")
+        if not isinstance(self.shard_index, (int, np.integer)) or not 0 <= self.shard_index < self.num_shards:
+            sys.exit("shard_index needs to be an integer between 0 and num_shards - 1.")
+        self.shard_combinations = list(range(self.shard_index, self.number_of_combinations, self.num_shards))
+
 
     def __append_to_list(self, param):
         if type(param) == list or type(param) == np.ndarray:
@@ -96,6 +129,16 @@ class ParamsParser():
         return current_parameters
 
 
+    def estimated_cost(self, param_idx, UP):
+        """
+        Rough relative cost of a parameter combination, proportional to the number
+        of k-points times the number of time steps. Used to order the combinations
+        for dynamic scheduling.
+        """
+        current_parameters = self.construct_current_parameters_and_header(param_idx, UP)
+
+        return current_parameters['Nk1']*current_parameters['Nk2']*abs(current_parameters['t0'])/current_parameters['dt']
+
     def distribute_parameters(self, param_idx, UP): # Take index of parameter (MPI-parallelized) and write current_parameters
 
         current_parameters = self.construct_current_parameters_and_header(param_idx, UP)
@@ -255,17 +298,63 @@ class ParamsParser():
         if 'only_save_time_data' in UP:
             self.only_save_time_data = UP['only_save_time_data']
 
+        self.save_output = True                           # Write the time/frequency data and params files
+        if 'save_output' in UP:
+            self.save_output = UP['save_output']
+
 
         if self.dm_dynamics_method in ('sbe', 'semiclassics'):
-            self.solver_method = 'bdf'                        # 'adams' non-stiff, 'bdf' stiff, 'rk4' Runge-Kutta 4th order
+            self.solver_method = 'bdf'                        # 'adams' non-stiff, 'bdf' stiff, 'rk4' Runge-Kutta 4th order,
+                                                              # 'etd_rk4' exponential rk4, exact band energy phase and damping
+                                                              # 'imex_rk3' implicit band energy phase and damping, explicit rest
             if 'solver_method' in UP:
                 self.solver_method = UP['solver_method']
 
+        self.rtol = 1e-6                                  # Relative tolerance of the adaptive ODE solvers
+        if 'rtol' in UP:
+            self.rtol = UP['rtol']
+
+        self.atol = 1e-12                                 # Absolute tolerance of the adaptive ODE solvers
+        if 'atol' in UP:
+            self.atol = UP['atol']
+
+        self.max_step = None                              # Maximal step of the adaptive ODE solvers in fs
+        if 'max_step' in UP:                              # (default: dt for bdf/adams, 1/(10 f) for dopri5)
+            self.max_step = UP['max_step']*CoFa.fs_to_au
+
+        self.jacobian = None                              # Jacobian of bdf/adams: None (functional iteration),
+        if 'jacobian' in UP:                              # 'numeric' (finite differences by zvode), 'analytic'
+            self.jacobian = UP['jacobian']                # or 'banded' (both length gauge only)
+
+        self.fast_forward_field_free = False              # Propagate steps without driving field analytically
+        if 'fast_forward_field_free' in UP:
+            self.fast_forward_field_free = UP['fast_forward_field_free']
+
+        self.field_free_tol = 1e-10*CoFa.MVpcm_to_au      # Field below which a time step counts as field-free
+        if 'field_free_tol' in UP:                        # (in MV/cm)
+            self.field_free_tol = UP['field_free_tol']*CoFa.MVpcm_to_au
+
+        self.batch_paths = False                          # Propagate all local paths in one batched rk4 step
+        if 'batch_paths' in UP:
+            self.batch_paths = UP['batch_paths']
+
+        self.jit_time_loop = False                        # Run the whole rk4 time loop of a path in numba
+        if 'jit_time_loop' in UP:
+            self.jit_time_loop = UP['jit_time_loop']
+
+        self.precompute_fields = False                    # Tabulate E and A on the rk4 stage grid once
+        if 'precompute_fields' in UP:
+            self.precompute_fields = UP['precompute_fields']
+
+        self.current_reduction = 'allreduce'              # MPI sum of the currents: 'allreduce' per array on all ranks,
+        if 'current_reduction' in UP:                     # 'reduce' as one packed buffer onto the writing rank
+            self.current_reduction = UP['current_reduction']
+
         self.dk_order = 8                                 # Accuracy order of density-matrix k-deriv.
         if 'dk_order' in UP:
-            self.dk_order = UP['dk_order']                   # with length gauge (avail: 2,4,6,8)
-            if self.dk_order not in [2, 4, 6, 8]:
-                sys.exit("dk_order needs to be either 2, 4, 6, or 8.")
+            self.dk_order = UP['dk_order']                   # with length gauge (avail: 2,4,6,8,'spectral')
+            if self.dk_order not in [2, 4, 6, 8, 'spectral']:
+                sys.exit("dk_order needs to be either 2, 4, 6, 8 or 'spectral'.")
 
         if self.dm_dynamics_method in ('series_expansion', 'EEA'):
 
@@ -354,6 +443,10 @@ class ParamsParser():
         self.do_fock = False
         if 'do_fock' in UP:
             self.do_fock = UP['do_fock']
+
+        self.fock_exchange = 'loop'                       # Fock exchange sums: 'loop' over all k' for every k,
+        if 'fock_exchange' in UP:                         # 'fft' as convolutions over the Brillouin zone
+            self.fock_exchange = UP['fock_exchange']
         
         if self.do_fock == True:  # split_paths = True and parallelize_over_points = False as default for Fock calculations
             if not 'split_paths' in UP:
@@ -396,11 +489,88 @@ class ParamsParser():
             if self.parallelize_over_points == True:
                 sys.exit('Paths can not be split if point parallelization is enabled')
 
+        if self.current_reduction not in ('allreduce', 'reduce'):
+            sys.exit("current_reduction needs to be either 'allreduce' or 'reduce'.")
+        if self.current_reduction == 'reduce' and self.save_dm_t:
+            sys.exit("save_dm_t is written by every rank and needs current_reduction = 'allreduce'.")
+
+        if self.split_k1 == True:
+            if self.gauge != 'length':
+                sys.exit('k1 can only be split in length gauge, use split_paths in velocity gauge.')
+            if self.dm_dynamics_method not in ('sbe', 'semiclassics') or self.solver_method != 'rk4':
+                sys.exit('Split k1 segments only run with the Runge-Kutta 4 ODE solver.')
+            if self.dk_order not in (2, 4, 6, 8):
+                sys.exit('Split k1 segments need a finite-difference dk_order of 2, 4, 6 or 8.')
+            if self.parallelize_over_points or self.split_paths or self.do_fock:
+                sys.exit('k1 can not be split together with parallelize_over_points, split_paths or do_fock.')
+            if self.batch_paths or self.jit_time_loop or self.fast_forward_field_free:
+                sys.exit('k1 can not be split together with batch_paths, jit_time_loop or fast_forward_field_free.')
+            if self.save_full or self.save_dm_t or self.save_latex_pdf:
+                sys.exit('Split k1 segments can not save k-resolved data (save_full, save_dm_t, save_latex_pdf).')
+
+        if self.points_per_block != 1:
+            if not isinstance(self.points_per_block, (int, np.integer)) or self.points_per_block < 1:
+                sys.exit('points_per_block needs to be a positive integer.')
+            if not self.parallelize_over_points:
+                sys.exit('points_per_block is only used with parallelize_over_points.')
+            if self.do_fock:
+                sys.exit('Fock calculations over points need points_per_block = 1.')
+
         if self.do_fock == True:
             if self.solver_method != 'rk4':
                 sys.exit('Fock calculations only run with unge-Kutta 4 ODE solver.')
             if self.solver != '2band':
                 sys.exit('Fock calculations are only implemented for 2 band solver so far.')
+            if self.fock_exchange not in ('loop', 'fft'):
+                sys.exit("fock_exchange needs to be either 'loop' or 'fft'.")
+            if self.fock_exchange == 'fft' and self.parallelize_over_points:
+                sys.exit('The FFT Fock exchange can not be combined with parallelize_over_points.')
+
+        if self.jacobian is not None:
+            if self.jacobian not in ('numeric', 'analytic', 'banded'):
+                sys.exit("jacobian needs to be either None, 'numeric', 'analytic' or 'banded'.")
+            if self.dm_dynamics_method not in ('sbe', 'semiclassics') or self.solver_method not in ('bdf', 'adams'):
+                sys.exit('The Jacobian is only used by the bdf and adams ODE solvers.')
+            if self.jacobian != 'numeric' and self.gauge != 'length':
+                sys.exit('The analytic Jacobian is only implemented in length gauge.')
+
+        if self.dk_order == 'spectral':
+            if self.precision != 'double':
+                sys.exit('The spectral k-derivative is only available in double precision.')
+            if self.jacobian == 'banded':
+                sys.exit('The spectral k-derivative couples all k-points of a path, use jacobian = \'analytic\'.')
+
+        if self.num_threads != 1:
+            if not isinstance(self.num_threads, (int, np.integer)) or self.num_threads < 1:
+                sys.exit('num_threads needs to be a positive integer.')
+            if self.precision != 'double':
+                sys.exit('Threaded k-loops are only available in double precision.')
+
+        if self.fast_forward_field_free == True:
+            if self.dm_dynamics_method not in ('sbe', 'semiclassics') or self.solver_method not in ('rk4', 'etd_rk4', 'imex_rk3'):
+                sys.exit('The field-free fast-forward only runs with the rk4, etd_rk4 and imex_rk3 ODE solvers.')
+            if self.do_fock or self.batch_paths or self.jit_time_loop:
+                sys.exit('The field-free fast-forward can not be combined with do_fock, batch_paths or jit_time_loop.')
+
+        if self.batch_paths == True:
+            if self.dm_dynamics_method not in ('sbe', 'semiclassics') or self.solver_method != 'rk4':
+                sys.exit('Batched path propagation only runs with the Runge-Kutta 4 ODE solver.')
+            if self.do_fock == True:
+                sys.exit('Batched path propagation is not implemented for Fock calculations.')
+            if self.split_current:
+                sys.exit('Batched path propagation only calculates the exact current, split_current is not available.')
+
+        if self.precompute_fields == True:
+            if self.dm_dynamics_method not in ('sbe', 'semiclassics') or self.solver_method != 'rk4':
+                sys.exit('Precomputed fields are only available for the Runge-Kutta 4 ODE solver.')
+            if self.batch_paths or self.jit_time_loop:
+                sys.exit('Precomputed fields can not be combined with batch_paths or jit_time_loop.')
+
+        if self.jit_time_loop == True:
+            if self.dm_dynamics_method not in ('sbe', 'semiclassics') or self.solver_method != 'rk4':
+                sys.exit('The compiled time loop only runs with the Runge-Kutta 4 ODE solver.')
+            if self.do_fock or self.split_current or self.save_full or self.batch_paths:
+                sys.exit('The compiled time loop can not be combined with do_fock, split_current, save_full or batch_paths.')
 
     def __append_derived_parameters(self, UP):
         ##################################################
@@ -1,12 +1,19 @@
 """
 Utility functions needed by functions/methods in the package
 """
+import hashlib
+import importlib.util
+import inspect
 import os
+import pickle
+import sys
+import numba
 from numba import njit
 import numpy as np
 import shutil as sh
 import sympy as sp
 from sympy.utilities.lambdify import lambdify
+from sympy.printing.lambdarepr import NumPyPrinter
 
 from cued import CUEDPATH
 
@@ -59,14 +66,18 @@ def rmdir_mkdir_chdir(dirname):
 
 class conditional_njit():
 	"""
-	njit execution only with double precision
+	njit execution only with double precision,
+	parallel=True distributes prange loops over the numba threads
 	"""
-	def __init__(self, precision):
+	def __init__(self, precision, parallel=False):
 		self.precision = precision
+		self.parallel = parallel
 
 	def __call__(self, func):
 		if self.precision in (np.float128, np.complex256):
 			return func
+		if self.parallel:
+			return njit(func, parallel=True)
 		return njit(func)
 
 
@@ -88,10 +99,18 @@ def list_to_njit_functions(sf, hsymbols, dtype=np.complex128, kpflag=False):
 	return [to_njit_function(sfn, hsymbols, dtype, kpflag) for sfn in sf]
 
 
+# Functions already converted in this process; later runs with the same
+# system (e.g. parameter sweeps) reuse them and their compiled code
+__njit_function_cache = {}
+
+
 def to_njit_function(sf, hsymbols, dtype=np.complex128, kpflag=False):
 	"""
 	Converts a simple sympy function to a function callable by numpy
 	"""
+	key = (sp.srepr(sf), frozenset(hsymbols), dtype, kpflag)
+	if key in __njit_function_cache:
+		return __njit_function_cache[key]
 
 	# Standard k variables
 	kx, ky = sp.symbols('kx ky', real=True)
@@ -99,9 +118,12 @@ def to_njit_function(sf, hsymbols, dtype=np.complex128, kpflag=False):
 	# Decide wheter we need to use the kp version of the program
 	if kpflag:
 		kxp, kyp = sp.symbols('kxp kyp', real=True)
-		return __to_njit_function_kp(sf, hsymbols, kx, ky, kxp, kyp, dtype=dtype)
+		function = __to_njit_function_kp(sf, hsymbols, kx, ky, kxp, kyp, dtype=dtype)
+	else:
+		function = __to_njit_function_k(sf, hsymbols, kx, ky, dtype=dtype)
 
-	return __to_njit_function_k(sf, hsymbols, kx, ky, dtype=dtype)
+	__njit_function_cache[key] = function
+	return function
 
 
 def __to_njit_function_k(sf, hsymbols, kx, ky, dtype=np.complex128):
@@ -111,13 +133,13 @@ def __to_njit_function_k(sf, hsymbols, kx, ky, dtype=np.complex128):
 	if contains_k:
 		# All free Hamiltonian symbols get function parameters
 		if dtype == np.complex256:
-			return lambdify(list(hsymbols), sf, np)
-		return njit(lambdify(list(hsymbols), sf, np))
+			return lambdify(sorted(hsymbols, key=str), sf, np)
+		return __cached_njit_lambdify(sorted(hsymbols, key=str), sf)
 	# Here we have non k variables in sf. Expand sf by 0*kx*ky
 	sf = sf + kx*ky*sp.UnevaluatedExpr(0)
 	if dtype == np.complex256:
-		return lambdify(list(hsymbols), sf, np)
-	return njit(lambdify(list(hsymbols), sf, np))
+		return lambdify(sorted(hsymbols, key=str), sf, np)
+	return __cached_njit_lambdify(sorted(hsymbols, key=str), sf)
 
 
 def __to_njit_function_kp(sf, hsymbols, kx, ky, kxp, kyp, dtype=np.complex128):
@@ -128,21 +150,226 @@ def __to_njit_function_kp(sf, hsymbols, kx, ky, kxp, kyp, dtype=np.complex128):
 	if contains_k:
 		# All free Hamiltonian symbols get function parameters
 		if dtype == np.complex256:
-			return lambdify(list(hsymbols), sf, np)
-		return njit(lambdify(list(hsymbols), sf, np))
+			return lambdify(sorted(hsymbols, key=str), sf, np)
+		return __cached_njit_lambdify(sorted(hsymbols, key=str), sf)
 
 	sf = sf + kx*ky*kxp*kyp*sp.UnevaluatedExpr(0)
 	if dtype == np.complex256:
-		return lambdify(list(hsymbols), sf, np)
-	return njit(lambdify(list(hsymbols), sf, np))
+		return lambdify(sorted(hsymbols, key=str), sf, np)
+	return __cached_njit_lambdify(sorted(hsymbols, key=str), sf)
+
+
+# Directory of the generated kernel modules, an empty CUED_KERNEL_CACHE
+# disables the on-disk cache
+__kernel_cache_dir = os.environ.get('CUED_KERNEL_CACHE',
+                                    os.path.join(os.path.expanduser('~'), '.cache', 'cued_kernels'))
+
+
+def __cached_njit_lambdify(args, sf):
+	"""
+	njit version of lambdify(args, sf, np), loaded from the kernel cache
+	directory if possible.
+	"""
+	function = lambdify(args, sf, np)
+	key = '|'.join([sp.srepr(sf), ','.join(str(arg) for arg in args)])
+	kernel = __import_cached_kernel(key, lambda: inspect.getsource(function), function.__name__)
+	if kernel is None:
+		return njit(function)
+	return kernel
+
+
+def __import_cached_kernel(key, make_source, funcname):
+	"""
+	Generated source is written to a module in the kernel cache directory, named
+	after the hash of key and the numba version, and funcname is compiled with
+	cache=True. Later processes (other MPI ranks, repeat runs) import the module
+	and load the compiled machine code instead of compiling again. make_source()
+	is only called if the module does not exist yet. Returns None if the cache
+	is disabled or cannot be used.
+	"""
+	if not __kernel_cache_dir:
+		return None
+
+	key = key + '|' + numba.__version__
+	modname = 'cued_kernel_' + hashlib.sha1(key.encode()).hexdigest()
+	if modname in sys.modules:
+		return sys.modules[modname].kernel
+
+	filename = os.path.join(__kernel_cache_dir, modname + '.py')
+	try:
+		if not os.path.exists(filename):
+			source = make_source()
+			os.makedirs(__kernel_cache_dir, exist_ok=True)
+			# Write atomically, other ranks might import the module at the same time
+			tmpname = filename + '.' + str(os.getpid())
+			with open(tmpname, 'w') as f:
+				f.write('# Generated by cued from sympy expressions\n'
+				        + 'import numpy\nfrom numpy import *\nfrom numba import njit\n\n'
+				        + source + '\n'
+				        + 'kernel = njit(cache=True)(' + funcname + ')\n')
+			os.replace(tmpname, filename)
+
+		spec = importlib.util.spec_from_file_location(modname, filename)
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+	except OSError:
+		# No source of the lambdified function or no writable cache directory
+		return None
+
+	sys.modules[modname] = module
+	return module.kernel
+
+
+def matrices_to_fused_njit_function(sfs, hsymbols, dtype=np.complex128):
+	"""
+	Converts a list of sympy matrices of equal shape (e.g. h, dh/dkx, dh/dky)
+	into a single function fjit(out, kx=kx, ky=ky, **fkwargs) that fills
+	out[m, :, r, c] with the element (r, c) of matrix m for all k-points.
+	Subexpressions shared by the elements are evaluated once (sympy.cse).
+	"""
+	kx, ky = sp.symbols('kx ky', real=True)
+	args = sorted(hsymbols.union({kx, ky}), key=str)
+	shp = sfs[0].shape
+	elements = [sf[r, c] for sf in sfs for r in range(shp[0]) for c in range(shp[1])]
+
+	def make_source():
+		replacements, reduced = sp.cse(elements, symbols=sp.numbered_symbols('_cse'))
+		printer = NumPyPrinter()
+		lines = ['def fused_matrices(out, ' + ', '.join(str(arg) for arg in args) + '):']
+		for symbol, expr in replacements:
+			lines.append('    ' + str(symbol) + ' = ' + printer.doprint(expr))
+		for idx, expr in enumerate(reduced):
+			m, rc = divmod(idx, shp[0]*shp[1])
+			lines.append('    out[{}, :, {}, {}] = {}'.format(m, rc//shp[1], rc%shp[1], printer.doprint(expr)))
+		lines.append('    return out')
+		return '\n'.join(lines) + '\n'
+
+	if dtype != np.complex256:
+		key = '|'.join(['fused'] + [sp.srepr(sf) for sf in sfs] + [','.join(str(arg) for arg in args)])
+		kernel = __import_cached_kernel(key, make_source, 'fused_matrices')
+		if kernel is not None:
+			return kernel
+
+	namespace = {}
+	exec('import numpy\nfrom numpy import *\n' + make_source(), namespace)
+	if dtype == np.complex256:
+		return namespace['fused_matrices']
+	return njit(namespace['fused_matrices'])
+
+
+# Directory of the pickled symbolic quantities of the Hamiltonians. Loading a
+# pickle executes code, so the cache is only used if P.symbolic_cache is set;
+# an empty CUED_SYMBOLIC_CACHE disables it as well
+__symbolic_cache_dir = os.environ.get('CUED_SYMBOLIC_CACHE',
+                                      os.path.join(os.path.expanduser('~'), '.cache', 'cued_symbolic'))
+
+
+def __symbolic_cache_file(key):
+	return os.path.join(__symbolic_cache_dir, hashlib.sha1((key + '|' + sp.__version__).encode()).hexdigest() + '.pickle')
 
 
-def evaluate_njit_matrix(mjit, kx=np.empty(1), ky=np.empty(1), dtype=np.complex128, **fkwargs):
+def load_symbolic_cache(key):
+	"""
+	Returns the dictionary of sympy objects stored under key (e.g. the srepr of a
+	Hamiltonian and the gauge) or None if nothing is stored yet.
+	"""
+	if not __symbolic_cache_dir:
+		return None
+	try:
+		with open(__symbolic_cache_file(key), 'rb') as f:
+			return pickle.load(f)
+	except (OSError, pickle.UnpicklingError, EOFError):
+		return None
+
+
+def store_symbolic_cache(key, quantities):
+	"""
+	Stores a dictionary of sympy objects under key, see load_symbolic_cache
+	"""
+	if not __symbolic_cache_dir:
+		return
+	filename = __symbolic_cache_file(key)
+	try:
+		os.makedirs(__symbolic_cache_dir, exist_ok=True)
+		# Write atomically, other processes might read the file at the same time
+		tmpname = filename + '.' + str(os.getpid())
+		with open(tmpname, 'wb') as f:
+			pickle.dump(quantities, f)
+		os.replace(tmpname, filename)
+	except OSError:
+		pass
+
+
+def cache_directories(symbolic_cache=False):
+	"""
+	Enabled on-disk caches of the compiled kernels and, if symbolic_cache is set,
+	of the symbolic quantities
+	"""
+	cache_dirs = (__symbolic_cache_dir, __kernel_cache_dir) if symbolic_cache else (__kernel_cache_dir,)
+	return [cache_dir for cache_dir in cache_dirs if cache_dir]
+
+
+def read_cache_files(symbolic_cache=False):
+	"""
+	Paths, contents and modification times of all files in the cache directories,
+	e.g. to hand a filled cache to other processes with write_cache_files
+	"""
+	files = []
+	for cache_dir in cache_directories(symbolic_cache):
+		for root, _dirs, filenames in os.walk(cache_dir):
+			for filename in sorted(filenames):
+				filepath = os.path.join(root, filename)
+				with open(filepath, 'rb') as f:
+					files.append((filepath, f.read(), os.stat(filepath).st_mtime_ns))
+	return files
+
+
+def write_cache_files(files):
+	"""
+	Writes the files from read_cache_files that do not exist yet. The modification
+	times are kept, numba only loads cached code if the source file is unchanged.
+	"""
+	for filepath, content, mtime_ns in files:
+		if os.path.exists(filepath):
+			continue
+		try:
+			os.makedirs(os.path.dirname(filepath), exist_ok=True)
+			tmpname = filepath + '.' + str(os.getpid())
+			with open(tmpname, 'wb') as f:
+				f.write(content)
+			os.utime(tmpname, ns=(mtime_ns, mtime_ns))
+			os.replace(tmpname, filepath)
+		except OSError:
+			pass
+
+
+def evaluate_njit_matrix(mjit, kx=np.empty(1), ky=np.empty(1), dtype=np.complex128, out=None, **fkwargs):
 	shp = np.shape(mjit)
-	numpy_matrix = np.empty((np.size(kx),) + shp, dtype=dtype)
+	if out is None:
+		numpy_matrix = np.empty((np.size(kx),) + shp, dtype=dtype)
+	else:
+		numpy_matrix = out
 
 	for r in range(shp[0]):
 		for c in range(shp[1]):
 			numpy_matrix[:, r, c] = mjit[r][c](kx=kx, ky=ky, **fkwargs)
 
 	return numpy_matrix
+
+
+def spectral_k_derivative(y):
+	"""
+	Derivative of periodic data along the first axis with respect to the grid
+	index, i.e. dy/dk*dk. The real and imaginary parts are transformed together
+	with real-to-complex FFTs and multiplied by i*k; the Nyquist mode of an even
+	number of points is dropped to keep the derivative of real data real.
+	"""
+	Nk = np.shape(y)[0]
+	parts = np.stack((y.real, y.imag))
+	ik = 2j*np.pi*np.fft.rfftfreq(Nk)
+	if Nk % 2 == 0:
+		ik[-1] = 0
+	ik = ik.reshape((1, ik.size) + (1,)*(np.ndim(y) - 1))
+	dparts = np.fft.irfft(ik*np.fft.rfft(parts, axis=1), n=Nk, axis=1)
+
+	return dparts[0] + 1j*dparts[1]
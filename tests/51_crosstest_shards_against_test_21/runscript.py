@@ -0,0 +1,25 @@
+from params import params
+
+import cued.hamiltonian
+from cued.main import sbe_solver, merge_shards
+
+def dirac():
+	A = 0.1974      # Fermi velocity
+
+	dirac_system = cued.hamiltonian.BiTe(C0=0, C2=0, A=A, R=0, mz=0)
+
+	return dirac_system
+
+def run(system):
+
+	# Shards normally run as separate jobs of a job array
+	for shard_index in range(params.num_shards):
+		params.shard_index = shard_index
+		sbe_solver(system, params)
+
+	merge_shards(params)
+
+	return 0
+
+if __name__ == "__main__":
+	run(dirac())
@@ -0,0 +1,31 @@
+import sys
+from params import params
+
+import cued.hamiltonian
+from cued.main import sbe_solver
+
+# Runs without PDF output must not import the plotting stack
+plotting_modules = ['matplotlib', 'tikzplotlib']
+
+def check_plotting_not_imported():
+	imported = [module for module in plotting_modules if module in sys.modules]
+	if imported:
+		sys.exit("Plotting modules imported without save_latex_pdf: " + ", ".join(imported))
+
+def dirac():
+	A = 0.1974      # Fermi velocity
+
+	dirac_system = cued.hamiltonian.BiTe(C0=0, C2=0, A=A, R=0, mz=0)
+
+	return dirac_system
+
+def run(system):
+
+	check_plotting_not_imported()
+	sbe_solver(system, params)
+	check_plotting_not_imported()
+
+	return 0
+
+if __name__ == "__main__":
+	run(dirac())